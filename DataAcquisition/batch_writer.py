@@ -0,0 +1,151 @@
+from datetime import datetime
+import json
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+JOURNAL_SUFFIX = ".jsonl.part"
+
+# Schema of the raw batches, the data attributes found in the cars details
+# (dt/dd pairs) vary between listings and are kept in a map
+raw_schema = pa.schema(
+    [
+        ("url", pa.string()),
+        ("country", pa.string()),
+        ("date", pa.timestamp("us")),
+        ("makeId", pa.int64()),
+        ("modelOrModelLineId", pa.int64()),
+        ("maker", pa.string()),
+        ("model", pa.string()),
+        ("modelVersionInput", pa.string()),
+        ("attributes", pa.map_(pa.string(), pa.string())),
+        ("dealer", pa.bool_()),
+        ("privateSeller", pa.bool_()),
+        ("price", pa.string()),
+        ("countryCode", pa.string()),
+        ("zip", pa.string()),
+        ("city", pa.string()),
+        ("street", pa.string()),
+    ]
+)
+missing_markers = {"NaN", "null", ""}
+
+
+def to_raw_row(record):
+    "Converts a scraped listing to a row of raw_schema"
+    row = {"attributes": []}
+    for key, value in record.items():
+        if key not in raw_schema.names:
+            row["attributes"].append((key, value))
+        elif value in missing_markers:
+            row[key] = None
+        elif key == "date":
+            row[key] = datetime.fromisoformat(value)
+        elif key in ("makeId", "modelOrModelLineId"):
+            row[key] = int(value) if value.isdigit() else None
+        else:
+            row[key] = value
+    return row
+
+
+class BatchWriter:
+    """Streams the scraped listings to a JSON lines journal in chunks, marking
+    them as visited once they are on disk. Closing the writer converts the
+    journal to the batch file read by the cleaner"""
+
+    def __init__(self, path, visited_urls, chunksize=50):
+        self.path = path
+        self.journal_path = os.path.splitext(path)[0] + JOURNAL_SUFFIX
+        self.visited_urls = visited_urls
+        self.chunksize = chunksize
+        self.buffer = []
+        self.count = 0
+
+    @classmethod
+    def resume(cls, folder, visited_urls, chunksize=50):
+        "Reopens the journal left by an interrupted run, if any"
+        journals = sorted(
+            file
+            for file in os.listdir(folder)
+            if file.endswith(JOURNAL_SUFFIX)
+            and not file.endswith("_db" + JOURNAL_SUFFIX)
+        )
+        if not journals:
+            return None
+        # Older journals are finalized, listings keep going to the latest one
+        writers = [
+            cls(
+                os.path.join(folder, file[: -len(JOURNAL_SUFFIX)] + ".parquet"),
+                visited_urls,
+                chunksize,
+            )
+            for file in journals
+        ]
+        for writer in writers:
+            writer.recover()
+        for writer in writers[:-1]:
+            writer.close()
+        return writers[-1]
+
+    def recover(self):
+        "Drops a partially written last line and marks the journal URLs as visited"
+        with open(self.journal_path, "rb+") as file:
+            content = file.read()
+            file.truncate(content.rfind(b"\n") + 1)
+        urls = [record["url"] for record in self.iter_journal()]
+        self.visited_urls.update(urls)
+        self.count = len(urls)
+
+    def write(self, URL, car_dict):
+        self.buffer.append({"url": URL, **car_dict})
+        if len(self.buffer) >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        "Appends the buffered listings to the journal, then marks them as visited"
+        if not self.buffer:
+            return
+        with open(self.journal_path, "a", encoding="utf-8") as file:
+            for record in self.buffer:
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.visited_urls.update(record["url"] for record in self.buffer)
+        self.count += len(self.buffer)
+        self.buffer = []
+
+    def iter_journal(self):
+        if not os.path.isfile(self.journal_path):
+            return
+        with open(self.journal_path, encoding="utf-8") as file:
+            for line in file:
+                yield json.loads(line)
+
+    def iter_journal_chunks(self):
+        chunk = []
+        for record in self.iter_journal():
+            chunk.append(record)
+            if len(chunk) >= self.chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def close(self):
+        "Converts the journal to the final batch file and removes it"
+        self.flush()
+        if self.count:
+            self.save_parquet()
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+
+    def save_parquet(self):
+        "Writes the journal to a Parquet file, a row group per chunk"
+        tmp_path = self.path + ".tmp"
+        with pq.ParquetWriter(tmp_path, raw_schema) as parquet_writer:
+            for chunk in self.iter_journal_chunks():
+                rows = [to_raw_row(record) for record in chunk]
+                parquet_writer.write_table(
+                    pa.Table.from_pylist(rows, schema=raw_schema)
+                )
+        os.replace(tmp_path, self.path)
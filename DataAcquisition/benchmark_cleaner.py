@@ -0,0 +1,169 @@
+from datetime import datetime
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import usedcars_scraper
+import usedcars_cleandata
+from benchmark_parser import load_fixtures, path_to_detail_fixtures
+
+
+def extract_text_data_multipass(df):
+    "Previous extract_text_data, a str.replace/str.extract chain per field"
+
+    price_pat = r"\€\s*(\d*),*"
+    km_pat = r"(\d*)\s*km"
+    pot_kw_pat = r"(\d*)\s*kW"
+    pot_cv_pat = r"\((\d*)\s*CV\)"
+    cil_cm3_pat = r"(\d*)\s*cm"
+    weight_kg_pat = r"(\d*)\s*kg"
+    emis_gkm_comb_pat = r"(\d*)\s*g/km\s*\(comb"
+    garanzia_mesi_pat = r"(\d*)\s*mesi"
+    consumo_comb_L100km_pat = r"(\d+\.?\d*)\sl/100\skm\s\(comb"
+    consumo_urb_L100km_pat = r"(\d+\.?\d*)\sl/100\skm\s\(urb"
+    consumo_extraurb_L100km_pat = r"(\d+\.?\d*)\sl/100\skm\s\(extraurb"
+
+    df["Anno"] = pd.to_datetime(df["Anno"], format="%m/%Y")
+
+    km_columns = ["Chilometraggio"]
+    price_columns = ["Prezzo_auto", "price", "Acconto"]
+
+    for col in km_columns:
+        df[col] = (
+            df[col]
+            .str.replace(".", "", regex=False)
+            .str.extract(pat=km_pat)
+            .astype(np.float64)
+        )
+
+    for col in price_columns:
+        df[col] = (
+            df[col]
+            .str.replace(".", "", regex=False)
+            .str.extract(pat=price_pat)
+            .astype(np.float64)
+        )
+
+    df["Cilindrata_cm3"] = (
+        df["Cilindrata_cm3"]
+        .str.replace(".", "", regex=False)
+        .str.extract(pat=cil_cm3_pat)
+        .astype(np.float64)
+    )
+    df["potenza_kw"] = (
+        df["Potenza"]
+        .str.replace(".", "", regex=False)
+        .str.extract(pat=pot_kw_pat)
+        .astype(np.float64)
+    )
+    df["potenza_cv"] = (
+        df["Potenza"]
+        .str.replace(".", "", regex=False)
+        .str.extract(pat=pot_cv_pat)
+        .astype(np.float64)
+    )
+
+    df["Peso_a_vuoto_kg"] = (
+        df["Peso_a_vuoto_kg"]
+        .str.replace(".", "", regex=False)
+        .str.extract(pat=weight_kg_pat)
+        .astype(np.float64)
+    )
+    df["Emissioni_CO2_gKm"] = (
+        df["Emissioni_CO2_gKm"]
+        .str.replace(".", "", regex=False)
+        .str.extract(pat=emis_gkm_comb_pat)
+        .astype(np.float64)
+    )
+    df["garanzia_mesi"] = (
+        df["garanzia_mesi"].str.extract(pat=garanzia_mesi_pat).astype(np.float64)
+    )
+
+    df["Consumo_comb_L100km"] = (
+        df["Consumo_di_carburante_L100km"]
+        .str.replace(",", ".", regex=False)
+        .str.extract(pat=consumo_comb_L100km_pat, expand=False)
+        .astype(np.float64)
+    )
+    df["Consumo_urb_L100km"] = (
+        df["Consumo_di_carburante_L100km"]
+        .str.replace(",", ".", regex=False)
+        .str.extract(pat=consumo_urb_L100km_pat, expand=False)
+        .astype(np.float64)
+    )
+    df["Consumo_extraurb_L100km"] = (
+        df["Consumo_di_carburante_L100km"]
+        .str.replace(",", ".", regex=False)
+        .str.extract(pat=consumo_extraurb_L100km_pat, expand=False)
+        .astype(np.float64)
+    )
+
+    return df
+
+
+def make_raw_batch(num_rows, seed=0):
+    "Builds a large raw batch from the detail fixtures, varying the numbers"
+    pages = load_fixtures(path_to_detail_fixtures)
+    cars_dicts = [
+        usedcars_scraper.parse_car_page(page, URL, "Italy")
+        for URL, page in pages.items()
+    ]
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame([cars_dicts[ii % len(cars_dicts)] for ii in range(num_rows)])
+    df.index = [f"/annunci/car-{ii}" for ii in range(num_rows)]
+    df.index.name = "url"
+    km = rng.integers(0, 300, num_rows) * 1000
+    df["Chilometraggio"] = [f"{k:,} km".replace(",", ".") for k in km]
+    prices = rng.integers(20, 800, num_rows) * 100
+    df["price"] = [f"€ {p:,},-".replace(",", ".") for p in prices]
+    return df
+
+
+def time_extraction(extract, df, repeat):
+    "Returns the rows extracted per second and the last result"
+    elapsed = 0
+    for _ in range(repeat):
+        df_copy = df.copy()
+        start = time.perf_counter()
+        result = extract(df_copy)
+        elapsed += time.perf_counter() - start
+    return repeat * len(df) / elapsed, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rows",
+        "-n",
+        dest="rows",
+        help="Number of listings in the batch",
+        type=int,
+        default=200000,
+    )
+    parser.add_argument(
+        "--repeat",
+        dest="repeat",
+        help="Number of timed runs",
+        type=int,
+        default=3,
+    )
+    args = parser.parse_args()
+
+    print(f"Benchmark started at {datetime.now()} on {args.rows} listings")
+    df = make_raw_batch(args.rows)
+    df = usedcars_cleandata.edit_index_columns(df)
+    df = usedcars_cleandata.add_missing_columns(df)
+
+    multipass_rate, expected = time_extraction(
+        extract_text_data_multipass, df, args.repeat
+    )
+    single_pass_rate, result = time_extraction(
+        usedcars_cleandata.extract_text_data, df, args.repeat
+    )
+    print(f"Multi pass extraction:  {multipass_rate:.0f} listings/sec")
+    print(
+        f"Single pass extraction: {single_pass_rate:.0f} listings/sec "
+        f"({single_pass_rate / multipass_rate:.1f}x)"
+    )
+    pd.testing.assert_frame_equal(result, expected)
+    print("Outputs are identical")
@@ -0,0 +1,76 @@
+from datetime import datetime
+import argparse
+import os
+import time
+import usedcars_scraper
+
+path_to_detail_fixtures = os.path.join("fixtures", "detail")
+
+
+def load_fixtures(path):
+    pages = {}
+    for file in sorted(os.listdir(path)):
+        if file.endswith(".html"):
+            with open(os.path.join(path, file), "rb") as page_file:
+                pages["/annunci/" + file[: -len(".html")]] = page_file.read()
+    return pages
+
+
+def time_parser(parser, pages, repeat):
+    "Returns the pages parsed per second and the dicts of the last round"
+    start = time.perf_counter()
+    for _ in range(repeat):
+        cars_dicts = {URL: parser(page, URL, "Italy") for URL, page in pages.items()}
+    elapsed = time.perf_counter() - start
+    return repeat * len(pages) / elapsed, cars_dicts
+
+
+def compare_cars_dicts(reference, candidate):
+    "Lists the fields where the two parsers disagree, ignoring the scrape date"
+    differences = []
+    for URL, ref_dict in reference.items():
+        cand_dict = candidate[URL]
+        for key in ref_dict.keys() | cand_dict.keys():
+            if key != "date" and ref_dict.get(key) != cand_dict.get(key):
+                differences.append((URL, key, ref_dict.get(key), cand_dict.get(key)))
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--fixtures",
+        "-f",
+        dest="fixtures",
+        help="Folder of saved car detail pages",
+        default=path_to_detail_fixtures,
+    )
+    parser.add_argument(
+        "--repeat",
+        "-n",
+        dest="repeat",
+        help="Number of parsing rounds over the fixtures",
+        type=int,
+        default=50,
+    )
+    args = parser.parse_args()
+
+    pages = load_fixtures(args.fixtures)
+    if not pages:
+        print("No fixtures found!")
+        exit()
+    print(f"Benchmark started at {datetime.now()} on {len(pages)} pages")
+
+    soup_rate, soup_dicts = time_parser(
+        usedcars_scraper.parse_car_page_soup, pages, args.repeat
+    )
+    fast_rate, fast_dicts = time_parser(
+        usedcars_scraper.parse_car_page, pages, args.repeat
+    )
+    print(f"Full soup parser: {soup_rate:.1f} pages/sec")
+    print(f"Fast parser:      {fast_rate:.1f} pages/sec ({fast_rate/soup_rate:.1f}x)")
+
+    differences = compare_cars_dicts(soup_dicts, fast_dicts)
+    print(f"Fields differing between parsers: {len(differences)}")
+    for URL, key, ref_value, cand_value in differences:
+        print(f"  {URL} {key}: {ref_value!r} != {cand_value!r}")
@@ -0,0 +1,136 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime
+import argparse
+import itertools
+import os
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import zlib
+import regex as re
+import usedcars_scraper
+import usedcars_cleandata
+from batch_writer import BatchWriter
+from benchmark_parser import load_fixtures, path_to_detail_fixtures
+
+path_to_search_fixture = os.path.join("fixtures", "search", "lst.html")
+pattern_car_link = re.compile(rb'href="/annunci/')
+pattern_page_prefix = re.compile(r"^/annunci/p\d+-\d+-")
+
+
+def make_handler(search_page, detail_pages):
+    "Request handler serving the fixtures in place of the used cars website"
+
+    class FixturesHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, as the real website
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path == "/lst":
+                # Every search page links the detail fixtures under unique URLs
+                page = urllib.parse.parse_qs(url.query).get("page", ["1"])[0]
+                counter = itertools.count()
+                body = pattern_car_link.sub(
+                    lambda _: f'href="/annunci/p{page}-{next(counter)}-'.encode(),
+                    search_page,
+                )
+            else:
+                body = detail_pages.get(pattern_page_prefix.sub("/annunci/", url.path))
+            if body is None:
+                self.send_error(404)
+                return
+            etag = f'"{zlib.crc32(body):x}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FixturesHandler
+
+
+def start_fixtures_server(search_page, detail_pages):
+    "Starts the local stand-in of the website, returns the server and its URL"
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), make_handler(search_page, detail_pages)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--numpages",
+        "-n",
+        dest="numpages",
+        help="Number of search pages to scrape",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        dest="workers",
+        help="Number of pages downloaded concurrently",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--trace-memory",
+        dest="trace_memory",
+        help="Trace Python allocations (slows down the pipeline)",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    with open(path_to_search_fixture, "rb") as file:
+        search_page = file.read()
+    detail_pages = load_fixtures(path_to_detail_fixtures)
+    server, website = start_fixtures_server(search_page, detail_pages)
+    usedcars_scraper.used_cars_website = website
+    usedcars_scraper.rate_limiter = usedcars_scraper.HostRateLimiter(0)
+    print(f"Benchmark started at {datetime.now()}, website stand-in at {website}")
+
+    if args.trace_memory:
+        tracemalloc.start()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Scraping streams the listings to a raw batch, as the scraper does
+        start = time.perf_counter()
+        car_URLs = usedcars_scraper.get_countries_car_URLs(
+            {"Italy": args.numpages}, 0, workers=args.workers
+        )
+        batch_path = os.path.join(tmp_dir, "batch.parquet")
+        writer = BatchWriter(batch_path, set())
+        for URL, car_dict in usedcars_scraper.iter_cars_dicts(car_URLs, args.workers):
+            writer.write(URL, car_dict)
+        writer.close()
+        scrape_time = time.perf_counter() - start
+        print()
+
+        start = time.perf_counter()
+        df = usedcars_cleandata.read_batch(batch_path)
+        df = usedcars_cleandata.clean_data(df)
+        clean_time = time.perf_counter() - start
+    if args.trace_memory:
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"Peak traced memory: {peak_traced / 2**20:.1f} MiB")
+    server.shutdown()
+
+    num_pages = args.numpages + len(car_URLs)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Pages scraped: {num_pages} ({num_pages / scrape_time:.1f} pages/sec)")
+    print(f"Listings cleaned: {len(df)} ({len(df) / clean_time:.1f} listings/sec)")
+    print(f"Peak memory: {peak_rss:.1f} MiB RSS")
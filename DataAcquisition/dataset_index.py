@@ -0,0 +1,134 @@
+import sqlite3
+import os
+import numpy as np
+import pandas as pd
+
+path_to_dataset_index = os.path.join("..", "data", "usedcars_dataset_index.sqlite")
+
+# Columns identifying the same car relisted under a different URL
+fingerprint_columns = ["maker", "model", "Anno", "Chilometraggio", "price", "zip"]
+
+
+def get_fingerprints(df):
+    "Hashes the fingerprint columns, listings missing any of them have none"
+    # Zips were stored without their leading zeros when read as numbers
+    columns = df[fingerprint_columns].assign(
+        zip=df["zip"].astype("string").str.strip().str.lstrip("0")
+    )
+    fingerprints = pd.util.hash_pandas_object(columns, index=False)
+    # SQLite integers are signed
+    fingerprints = pd.Series(fingerprints.to_numpy().view(np.int64), index=df.index)
+    return fingerprints.astype("Int64").mask(columns.isna().any(axis=1))
+
+
+class DatasetIndex:
+    """Persistent index of the listings stored in the dataset, keyed by URL
+    and by the fingerprint of their content"""
+
+    def __init__(self, path=path_to_dataset_index):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS listings "
+                "(url TEXT PRIMARY KEY, batch TEXT, fingerprint INTEGER) WITHOUT ROWID"
+            )
+            columns = [
+                row[1] for row in self.connection.execute("PRAGMA table_info(listings)")
+            ]
+            if "fingerprint" not in columns:
+                # Indexes created before fingerprints, filled by set_fingerprints
+                self.connection.execute(
+                    "ALTER TABLE listings ADD COLUMN fingerprint INTEGER"
+                )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS listings_fingerprint "
+                "ON listings (fingerprint)"
+            )
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+
+    def find(self, column, values, chunksize=500):
+        "Returns {value: (url, batch)} for the given values of column in the index"
+        values = list(values)
+        found = {}
+        for start in range(0, len(values), chunksize):
+            chunk = values[start : start + chunksize]
+            placeholders = ",".join("?" * len(chunk))
+            for row in self.connection.execute(
+                f"SELECT {column}, url, batch FROM listings "
+                f"WHERE {column} IN ({placeholders})",
+                chunk,
+            ):
+                found.setdefault(row[0], row[1:])
+        return found
+
+    def filter_new(self, df, fingerprints, batch, drop_near_duplicates=False):
+        """Drops the listings already in the dataset, keeping the first of a
+        batch. Exact duplicates have the same URL, near duplicates the same
+        fingerprint under another URL and are only dropped on request, as
+        identical cars of a dealer share it. Returns the new listings and a
+        report of the duplicates found"""
+        fingerprints = [
+            None if pd.isna(value) else int(value) for value in fingerprints
+        ]
+        indexed_urls = self.find("url", set(df.index))
+        indexed_fingerprints = self.find(
+            "fingerprint", {value for value in fingerprints if value is not None}
+        )
+        batch_urls = {}
+        batch_fingerprints = {}
+        keep = []
+        report = []
+        for url, fingerprint in zip(df.index, fingerprints):
+            original = indexed_urls.get(url) or batch_urls.get(url)
+            if original:
+                report.append((url, batch, "exact", *original))
+                keep.append(False)
+                continue
+            batch_urls[url] = (url, batch)
+            original = indexed_fingerprints.get(fingerprint) or batch_fingerprints.get(
+                fingerprint
+            )
+            if original:
+                report.append((url, batch, "near", *original))
+                keep.append(not drop_near_duplicates)
+            else:
+                keep.append(True)
+            if fingerprint is not None:
+                batch_fingerprints.setdefault(fingerprint, (url, batch))
+        report = pd.DataFrame(
+            report, columns=["url", "batch", "kind", "duplicate_of", "duplicate_batch"]
+        )
+        return df[keep], report
+
+    def update(self, urls, batch, fingerprints=None):
+        if fingerprints is None:
+            fingerprints = [None] * len(urls)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO listings (url, batch, fingerprint) "
+                "VALUES (?, ?, ?)",
+                (
+                    (url, batch, None if pd.isna(value) else int(value))
+                    for url, value in zip(urls, fingerprints)
+                ),
+            )
+
+    def remove_batch(self, batch):
+        "Removes the listings of a batch, returns their number"
+        with self.connection:
+            return self.connection.execute(
+                "DELETE FROM listings WHERE batch = ?", (batch,)
+            ).rowcount
+
+    def set_fingerprints(self, fingerprints):
+        "Fills the fingerprints of indexed listings from a {url: fingerprint} Series"
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE listings SET fingerprint = ? WHERE url = ?",
+                ((int(value), url) for url, value in fingerprints.dropna().items()),
+            )
+
+    def close(self):
+        self.connection.close()
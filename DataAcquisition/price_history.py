@@ -0,0 +1,141 @@
+import sqlite3
+import os
+import pandas as pd
+
+path_to_price_history = os.path.join("..", "data", "usedcars_price_history.sqlite")
+# Prices of the visited cars shown in the search results, a file for each run
+path_to_price_sightings = os.path.join("..", "data", "price_sightings")
+sightings_columns = ["url", "country", "date", "price"]
+
+
+class PriceHistory:
+    """Prices of the listings over time. Each listing has an integer id and
+    only the sightings where its price changes are stored, the last one seen
+    is kept in the listings table to compare the next sightings with"""
+
+    def __init__(self, path=path_to_price_history):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS listings ("
+                "id INTEGER PRIMARY KEY, url TEXT UNIQUE, maker TEXT, model TEXT, "
+                "last_date INTEGER, last_price INTEGER)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS listings_model ON listings (maker, model)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS prices ("
+                "listing_id INTEGER, date INTEGER, price INTEGER, "
+                "PRIMARY KEY (listing_id, date)) WITHOUT ROWID"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sightings_files (name TEXT PRIMARY KEY)"
+            )
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM prices").fetchone()[0]
+
+    def record(self, df, add_listings=True):
+        """Records the prices of a cleaned batch, dates are stored as seconds
+        since the epoch. Sightings older than the last one of a listing or
+        with the same price are skipped, as well as the sightings of unknown
+        listings unless add_listings. Returns the number of changes stored"""
+        df = df[df["price"].notna() & df["date"].notna()]
+        missing = pd.Series(None, index=df.index, dtype=object)
+        sightings = zip(
+            df.index,
+            df["maker"].astype(object) if "maker" in df.columns else missing,
+            df["model"].astype(object) if "model" in df.columns else missing,
+            df["date"].astype("int64") // 10**9,
+            df["price"].astype("int64"),
+        )
+        changes = 0
+        with self.connection:
+            for url, maker, model, date, price in sightings:
+                listing = self.connection.execute(
+                    "SELECT id, last_date, last_price FROM listings WHERE url = ?",
+                    (url,),
+                ).fetchone()
+                if listing is None:
+                    if not add_listings:
+                        continue
+                    listing_id = self.connection.execute(
+                        "INSERT INTO listings (url, maker, model, last_date, last_price) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (url, none_if_na(maker), none_if_na(model), date, price),
+                    ).lastrowid
+                else:
+                    listing_id, last_date, last_price = listing
+                    if date <= last_date:
+                        continue
+                    self.connection.execute(
+                        "UPDATE listings SET last_date = ?, last_price = ? WHERE id = ?",
+                        (date, price, listing_id),
+                    )
+                    if price == last_price:
+                        continue
+                self.connection.execute(
+                    "INSERT INTO prices (listing_id, date, price) VALUES (?, ?, ?)",
+                    (listing_id, date, price),
+                )
+                changes += 1
+        return changes
+
+    def has_sightings(self, name):
+        "Tells if a file of price sightings was already recorded"
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM sightings_files WHERE name = ?", (name,)
+            ).fetchone()
+            is not None
+        )
+
+    def record_sightings(self, name, df):
+        """Records the prices of the visited cars seen again by the scraper,
+        from a file of price sightings. Returns the number of changes stored"""
+        changes = self.record(df, add_listings=False)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO sightings_files (name) VALUES (?)", (name,)
+            )
+        return changes
+
+    def get_listing_history(self, url):
+        "Returns the price changes of a listing"
+        return self.query(
+            "SELECT p.date, p.price FROM prices p "
+            "JOIN listings l ON l.id = p.listing_id WHERE l.url = ? ORDER BY p.date",
+            (url,),
+        )
+
+    def get_model_history(self, maker, model):
+        "Returns the price changes of all the listings of a model"
+        return self.query(
+            "SELECT l.url, p.date, p.price FROM listings l "
+            "JOIN prices p ON p.listing_id = l.id "
+            "WHERE l.maker = ? AND l.model = ? ORDER BY l.url, p.date",
+            (maker, model),
+        )
+
+    def query(self, sql, params):
+        df = pd.read_sql_query(sql, self.connection, params=params)
+        df["date"] = pd.to_datetime(df["date"], unit="s")
+        return df
+
+    def close(self):
+        self.connection.close()
+
+
+def none_if_na(value):
+    return None if pd.isna(value) else value
+
+
+def save_price_sightings(sightings, path):
+    "Writes the (url, country, date, price) sightings of a scraper run"
+    if not os.path.isdir(os.path.dirname(path)):
+        os.mkdir(os.path.dirname(path))
+    df = pd.DataFrame(sightings, columns=sightings_columns)
+    tmp_path = path + ".tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+path_to_http_cache = os.path.join("..", "data", "http_cache.sqlite")
+# Cache of previous versions, a single JSON file rewritten at each run
+path_to_legacy_http_cache = os.path.join("..", "data", "http_cache.json")
+
+
+class ScraperSession:
+    """HTTP session shared by the scraper threads: keeps connections alive,
+    retries failed requests with backoff and revalidates cached pages"""
+
+    def __init__(self, pool_size=10, retries=3, backoff=0.5, timeout=30):
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        # requests already asks for gzip/deflate and for br when brotli is installed
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timeout = timeout
+        # Validators and content of the pages fetched with conditional requests,
+        # with the time they were last used
+        self.cache = {}
+        self.lock = threading.Lock()
+        # Pages downloaded and revalidated in this run, saved by save_cache
+        self.fetched = set()
+        self.revalidated = set()
+
+    def get(self, url, conditional=False):
+        "Returns the page content, revalidating the cached copy if conditional"
+        headers = {}
+        cached = self.cache.get(url) if conditional else None
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and cached:
+            cached["used"] = time.time()
+            self.revalidated.add(url)
+            return cached["content"]
+        response.raise_for_status()
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if conditional and (etag or last_modified):
+            with self.lock:
+                self.cache[url] = {
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "content": response.content,
+                    "used": time.time(),
+                }
+                self.fetched.add(url)
+        return response.content
+
+    def load_cache(self, path=path_to_http_cache):
+        "Loads the cached pages, an unreadable cache is dropped"
+        if os.path.isfile(path_to_legacy_http_cache):
+            os.remove(path_to_legacy_http_cache)
+        if not os.path.isfile(path):
+            return
+        try:
+            connection = sqlite3.connect(path)
+            rows = connection.execute(
+                "SELECT url, etag, last_modified, content, used FROM pages"
+            ).fetchall()
+            connection.close()
+        except sqlite3.DatabaseError as e:
+            print(f"Dropping the unreadable HTTP cache: {e}")
+            os.remove(path)
+            return
+        for url, etag, last_modified, content, used in rows:
+            self.cache[url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "content": content,
+                "used": used,
+            }
+
+    def save_cache(self, path=path_to_http_cache, max_pages=1000):
+        """Saves the pages downloaded or revalidated in this run, in a single
+        transaction, keeping the max_pages most recently used pages"""
+        with self.lock:
+            fetched = [(url, self.cache[url]) for url in self.fetched]
+            revalidated = [(self.cache[url]["used"], url) for url in self.revalidated]
+        connection = sqlite3.connect(path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, "
+            "last_modified TEXT, content BLOB, used REAL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS pages_used ON pages (used)")
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        url,
+                        entry["etag"],
+                        entry["last_modified"],
+                        entry["content"],
+                        entry["used"],
+                    )
+                    for url, entry in fetched
+                ),
+            )
+            connection.executemany(
+                "UPDATE pages SET used = ? WHERE url = ?", revalidated
+            )
+            connection.execute(
+                "DELETE FROM pages WHERE url NOT IN "
+                "(SELECT url FROM pages ORDER BY used DESC LIMIT ?)",
+                (max_pages,),
+            )
+        connection.close()
@@ -1,59 +1,128 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
 from datetime import datetime
 import argparse
 import regex as re
 import os
 import json
+import shutil
+import sys
 import pandas as pd
 import numpy as np
+import pyarrow.parquet as pq
 
-main_columns = sorted(
-    [
-        "Acconto",
-        "Anno",
-        "Carburante",
-        "Carrozzeria",
-        "Chilometraggio",
-        "Cilindrata_cm3",
-        "Cilindri",
-        "Colore",
-        "Comfort",
-        "Consumo_comb_L100km",
-        "Consumo_extraurb_L100km",
-        "Consumo_urb_L100km",
-        "Emissioni_CO2_gKm",
-        "Extra",
-        "Intrattenimento__Media",
-        "Marce",
-        "Peso_a_vuoto_kg",
-        "Porte",
-        "Posti",
-        "Prezzo_auto",
-        "Sicurezza",
-        "Tagliandi_certificati",
-        "Tipo_di_cambio",
-        "Tipo_di_veicolo",
-        "Trazione",
-        "city",
-        "country",
-        "countryCode",
-        "date",
-        "garanzia_mesi",
-        "makeId",
-        "maker",
-        "model",
-        "modelOrModelLineId",
-        "modelVersionInput",
-        "potenza_cv",
-        "potenza_kw",
-        "price",
-        "street",
-        "unico_proprietario",
-        "zip",
-    ]
+# The offers and the aggregates read by the app are exported by Serving
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Serving")
+)
+from dashboard_aggregates import is_export_stale
+from dataset_index import DatasetIndex, get_fingerprints, path_to_dataset_index
+from price_history import (
+    PriceHistory,
+    path_to_price_history,
+    path_to_price_sightings,
 )
 
+fuel_categories = ["Benzina", "Diesel", "Ibrida", "Elettrica", "GPL", "Metano", "Altro"]
+car_body_categories = [
+    "SUV/Fuoristrada",
+    "Berlina",
+    "Station Wagon",
+    "City Car",
+    "Monovolume",
+    "Coupe",
+    "Cabrio",
+    "Furgone",
+    "Altro",
+]
+
+# Types of the stored columns, the same for all the dataset parts.
+# Integers are nullable and as narrow as their values allow
+main_schema = {
+    "Acconto": "Int32",
+    "Anno": "datetime64[ns]",
+    "Carburante": pd.CategoricalDtype(fuel_categories),
+    "Carrozzeria": pd.CategoricalDtype(car_body_categories),
+    "Chilometraggio": "Int32",
+    "Cilindrata_cm3": "Int32",
+    "Cilindri": "Int8",
+    "Colore": "category",
+    "Comfort": "string",
+    "Consumo_comb_L100km": "Float32",
+    "Consumo_extraurb_L100km": "Float32",
+    "Consumo_urb_L100km": "Float32",
+    "Emissioni_CO2_gKm": "Int16",
+    "Extra": "string",
+    "Intrattenimento__Media": "string",
+    "Marce": "Int8",
+    "Peso_a_vuoto_kg": "Int16",
+    "Porte": "Int8",
+    "Posti": "Int8",
+    "Prezzo_auto": "Int32",
+    "Sicurezza": "string",
+    "Tagliandi_certificati": "bool",
+    "Tipo_di_cambio": "category",
+    "Tipo_di_veicolo": "category",
+    "Trazione": "category",
+    "city": "string",
+    "country": "category",
+    "countryCode": "category",
+    "date": "datetime64[ns]",
+    "garanzia_mesi": "Int16",
+    "makeId": "Int32",
+    "maker": "category",
+    "model": "category",
+    "modelOrModelLineId": "Int32",
+    "modelVersionInput": "string",
+    "potenza_cv": "Int16",
+    "potenza_kw": "Int16",
+    "price": "Int32",
+    "street": "string",
+    "unico_proprietario": "bool",
+    "zip": "string",
+}
+main_columns = sorted(main_schema)
+
+# Numeric fields extracted from the text columns, as
+# source column: (chars replaced before matching, {field: regex})
+price_pat = r"\€\s*(\d*),*"
+text_fields = {
+    "Chilometraggio": ((".", ""), {"Chilometraggio": r"(\d*)\s*km"}),
+    "Prezzo_auto": ((".", ""), {"Prezzo_auto": price_pat}),
+    "price": ((".", ""), {"price": price_pat}),
+    "Acconto": ((".", ""), {"Acconto": price_pat}),
+    "Cilindrata_cm3": ((".", ""), {"Cilindrata_cm3": r"(\d*)\s*cm"}),
+    "Potenza": (
+        (".", ""),
+        {"potenza_kw": r"(\d*)\s*kW", "potenza_cv": r"\((\d*)\s*CV\)"},
+    ),
+    "Peso_a_vuoto_kg": ((".", ""), {"Peso_a_vuoto_kg": r"(\d*)\s*kg"}),
+    "Emissioni_CO2_gKm": (
+        (".", ""),
+        {"Emissioni_CO2_gKm": r"(\d*)\s*g/km\s*\(comb"},
+    ),
+    "garanzia_mesi": (None, {"garanzia_mesi": r"(\d*)\s*mesi"}),
+    "Consumo_di_carburante_L100km": (
+        (",", "."),
+        {
+            "Consumo_comb_L100km": r"(\d+\.?\d*)\sl/100\skm\s\(comb",
+            "Consumo_urb_L100km": r"(\d+\.?\d*)\sl/100\skm\s\(urb",
+            "Consumo_extraurb_L100km": r"(\d+\.?\d*)\sl/100\skm\s\(extraurb",
+        },
+    ),
+}
+
 path_to_added_batches = os.path.join("..", "data", "added_batches.json")
+# The dataset is a folder of Parquet files, one for each batch
 path_to_full_dataset = os.path.join("..", "data", "usedcars_dataset.parquet")
+path_to_legacy_dataset = path_to_full_dataset + ".legacy"
+path_to_duplicates_report = os.path.join("..", "data", "duplicates_report.csv")
+# Version of the column types and fingerprints, existing parts are rewritten
+# when it changes
+dataset_version = 5
+path_to_dataset_version = os.path.join(path_to_full_dataset, "_dataset_version")
 
 
 def initWSCleaner():
@@ -64,31 +133,132 @@ def initWSCleaner():
         with open(path_to_added_batches, "w") as file:
             json.dump([], file)
 
-    if not os.path.isfile(path_to_full_dataset):
-        df = pd.DataFrame(columns=main_columns)
-        df.index.name = "url"
-        df.to_parquet(path_to_full_dataset, index=True)
+    if os.path.isfile(path_to_full_dataset) or os.path.isfile(path_to_legacy_dataset):
+        migrate_full_dataset()
+
+    if not os.path.isdir(path_to_full_dataset):
+        os.mkdir(path_to_full_dataset)
+
+    if get_dataset_version() != dataset_version:
+        upgrade_dataset_parts()
+
+
+def get_dataset_version():
+    if not os.path.isfile(path_to_dataset_version):
+        return None
+    with open(path_to_dataset_version) as file:
+        return int(file.read())
+
+
+def set_dataset_version():
+    with open(path_to_dataset_version, "w") as file:
+        file.write(str(dataset_version))
+
+
+def upgrade_dataset_parts():
+    """Rewrites the existing dataset parts with the current column types,
+    refreshing the fingerprints of their listings in the index"""
+    parts = [
+        file
+        for file in sorted(os.listdir(path_to_full_dataset))
+        if file.startswith("part-")
+    ]
+    if parts:
+        print(f"Upgrading {len(parts)} dataset parts to version {dataset_version}")
+    index = DatasetIndex()
+    for part in parts:
+        df = pd.read_parquet(os.path.join(path_to_full_dataset, part))
+        df = apply_main_dtypes(df)
+        write_dataset_part(df, part[len("part-") :])
+        index.set_fingerprints(get_fingerprints(df))
+    index.close()
+    set_dataset_version()
+
+
+def migrate_full_dataset():
+    "Moves a single file dataset into the folder of dataset parts, once"
+    print("Migrating the dataset to a folder of batches")
+    if os.path.isfile(path_to_full_dataset):
+        os.replace(path_to_full_dataset, path_to_legacy_dataset)
+    if os.path.exists(path_to_dataset_index):
+        os.remove(path_to_dataset_index)
+    if not os.path.isdir(path_to_full_dataset):
+        os.mkdir(path_to_full_dataset)
+
+    df = apply_main_dtypes(pd.read_parquet(path_to_legacy_dataset))
+    df = df[~df.index.duplicated(keep="first")]
+    write_dataset_part(df, "legacy")
+    index = DatasetIndex()
+    index.update(df.index, "legacy", get_fingerprints(df))
+    index.close()
+    price_history = PriceHistory()
+    price_history.record(df)
+    price_history.close()
+    set_dataset_version()
+    os.remove(path_to_legacy_dataset)
+
+
+def reset_full_dataset():
+    "Removes all the dataset parts, their index and the price history"
+    shutil.rmtree(path_to_full_dataset)
+    os.mkdir(path_to_full_dataset)
+    set_dataset_version()
+    for path in [path_to_dataset_index, path_to_price_history]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def write_dataset_part(df, batch):
+    "Writes the cleaned listings of a batch as a new file of the dataset"
+    part_name = "part-" + os.path.splitext(batch)[0] + ".parquet"
+    # Hidden while written, so that readers of the dataset skip it
+    tmp_path = os.path.join(path_to_full_dataset, "." + part_name + ".tmp")
+    df.to_parquet(tmp_path, index=True)
+    os.replace(tmp_path, os.path.join(path_to_full_dataset, part_name))
+
+
+def remove_batch_parts(batch):
+    "Removes the dataset parts of a batch, whole or in chunks"
+    stem = os.path.splitext(batch)[0]
+    pattern = re.compile(re.escape("part-" + stem) + r"(-\d{5})?\.parquet")
+    for file in os.listdir(path_to_full_dataset):
+        if pattern.fullmatch(file):
+            os.remove(os.path.join(path_to_full_dataset, file))
+
+
+def check_serving_export():
+    "Tells when the offers exported for Serving are older than the dataset"
+    # The export reads the whole dataset, it is left out of the hourly cleaning
+    if is_export_stale(path_to_full_dataset):
+        print("Serving offers out of date, export them with dashboard_aggregates.py")
+
+
+def save_duplicates_report(report):
+    "Appends the duplicates found in a batch to the report"
+    write_header = not os.path.isfile(path_to_duplicates_report)
+    report.to_csv(path_to_duplicates_report, mode="a", header=write_header, index=False)
+
+
+def save_added_batches(added_batches):
+    with open(path_to_added_batches, "w") as file:
+        json.dump(added_batches, file)
 
 
 def getTargets(target, added_batches):
     if target:
         file_path = os.path.join("..", "data", target)
-        # Filepath must be a .csv file, different from main dataset
-        if (
-            os.path.isfile(file_path)
-            and file_path.endswith(".csv")
-            and file_path != path_to_full_dataset
-        ):
+        # Filepath must be a .parquet or .csv file, different from main dataset
+        if os.path.isfile(file_path) and is_batch(target):
             target_list = [target]
         else:
             print("Target not found or inconsistent!")
             target_list = []
     else:
-        # Target all csv in data folder
+        # Target all batches in data folder
         target_list = [
             file
             for file in sorted(os.listdir(os.path.join("..", "data")))
-            if file.endswith(".csv") and file != "usedcars_dataset.csv"
+            if is_batch(file)
         ]
 
     target_list = [tar for tar in target_list if tar not in added_batches]
@@ -96,6 +266,69 @@ def getTargets(target, added_batches):
     return target_list
 
 
+def is_batch(file):
+    "Tells the batches from the other files of the data folder"
+    return file.endswith((".parquet", ".csv")) and file not in [
+        os.path.basename(path_to_full_dataset),
+        os.path.basename(path_to_duplicates_report),
+    ]
+
+
+def read_batch(file_path):
+    "Reads a raw batch saved by the scraper, as Parquet or legacy CSV"
+    if file_path.endswith(".csv"):
+        return pd.read_csv(file_path, sep=";", index_col="url", dtype={"zip": str})
+
+    return expand_raw_parquet(pd.read_parquet(file_path))
+
+
+def iter_batch_chunks(file_path, chunksize):
+    "Reads a raw batch in chunks of listings, without loading it whole"
+    if file_path.endswith(".csv"):
+        yield from pd.read_csv(
+            file_path, sep=";", index_col="url", dtype={"zip": str}, chunksize=chunksize
+        )
+        return
+
+    for record_batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunksize):
+        yield expand_raw_parquet(record_batch.to_pandas())
+
+
+def get_sightings_files():
+    "Lists the files of price sightings saved by the scraper"
+    if not os.path.isdir(path_to_price_sightings):
+        return []
+    return sorted(
+        file
+        for file in os.listdir(path_to_price_sightings)
+        if file.endswith(".parquet")
+    )
+
+
+def read_price_sightings(file):
+    "Reads the prices of visited cars saved by the scraper, cleaned as the batches"
+    df = pd.read_parquet(os.path.join(path_to_price_sightings, file))
+    df = df.set_index("url")
+    df.index = df.index.str.strip("/annunci/")
+    df["date"] = pd.to_datetime(df["date"])
+    replace, fields = text_fields["price"]
+    prices = extract_fields(df["price"], replace, fields, df.index)["price"]
+    df["price"] = to_nullable_int(prices, main_schema["price"])
+    return df
+
+
+def expand_raw_parquet(df):
+    "Converts the raw Parquet listings to the columns of the legacy CSV batches"
+    df = df.set_index("url")
+    df["date"] = df["date"].astype(str)
+    # Data attributes are kept as text, typed by apply_main_dtypes as the zip
+    attributes = pd.DataFrame.from_records(
+        [dict(items) for items in df.pop("attributes")], index=df.index
+    )
+    attributes = attributes.replace("", np.nan)
+    return pd.concat([df, attributes], axis=1)
+
+
 def edit_index_columns(df):
     "Sets index from URL and rename columns"
     df.index = df.index.str.strip("/annunci/")
@@ -124,6 +357,35 @@ def drop_columns(df):
     return df
 
 
+def apply_main_dtypes(df):
+    "Casts the columns to the types of the dataset"
+    for col, dtype in main_schema.items():
+        if dtype == "bool":
+            df[col] = df[col].fillna(False).astype(bool)
+        elif dtype == "datetime64[ns]":
+            df[col] = pd.to_datetime(df[col])
+        elif dtype in ("Int8", "Int16", "Int32"):
+            df[col] = to_nullable_int(df[col], dtype)
+        elif dtype == "Float32":
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(dtype)
+        elif dtype == "string" and pd.api.types.is_numeric_dtype(df[col]):
+            # Codes read as numbers (e.g. zip) are stored without decimals
+            df[col] = df[col].astype("Int64").astype(dtype)
+        elif dtype == "category":
+            df[col] = df[col].astype("string").astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def to_nullable_int(series, dtype):
+    "Rounds a numeric column to a nullable integer, values out of range are missing"
+    values = pd.to_numeric(series, errors="coerce").round()
+    info = np.iinfo(dtype.lower())
+    values = values.where(values.between(info.min, info.max))
+    return values.astype(dtype)
+
+
 def add_missing_columns(df):
     "Add columns in main_columns not found in processed DataFrame, filled with None"
     col_to_add = [col for col in main_columns if col not in df.columns]
@@ -134,95 +396,34 @@ def add_missing_columns(df):
 
 def extract_text_data(df):
     "Applies regex to extract data from descriptions"
-
-    price_pat = r"\€\s*(\d*),*"
-    km_pat = r"(\d*)\s*km"
-    pot_kw_pat = r"(\d*)\s*kW"
-    pot_cv_pat = r"\((\d*)\s*CV\)"
-    cil_cm3_pat = r"(\d*)\s*cm"
-    weight_kg_pat = r"(\d*)\s*kg"
-    emis_gkm_comb_pat = r"(\d*)\s*g/km\s*\(comb"
-    garanzia_mesi_pat = r"(\d*)\s*mesi"
-    consumo_comb_L100km_pat = r"(\d+\.?\d*)\sl/100\skm\s\(comb"
-    consumo_urb_L100km_pat = r"(\d+\.?\d*)\sl/100\skm\s\(urb"
-    consumo_extraurb_L100km_pat = r"(\d+\.?\d*)\sl/100\skm\s\(extraurb"
-
     df["Anno"] = pd.to_datetime(df["Anno"], format="%m/%Y")
 
-    km_columns = ["Chilometraggio"]
-    price_columns = ["Prezzo_auto", "price", "Acconto"]
+    for source_col, (replace, fields) in text_fields.items():
+        extracted = extract_fields(df.get(source_col), replace, fields, df.index)
+        for col in fields:
+            df[col] = extracted[col]
 
-    for col in km_columns:
-        df[col] = (
-            df[col]
-            .str.replace(".", "", regex=False)
-            .str.extract(pat=km_pat)
-            .astype(np.float64)
-        )
+    return df
 
-    for col in price_columns:
-        df[col] = (
-            df[col]
-            .str.replace(".", "", regex=False)
-            .str.extract(pat=price_pat)
-            .astype(np.float64)
-        )
 
-    df["Cilindrata_cm3"] = (
-        df["Cilindrata_cm3"]
-        .str.replace(".", "", regex=False)
-        .str.extract(pat=cil_cm3_pat)
-        .astype(np.float64)
-    )
-    df["potenza_kw"] = (
-        df["Potenza"]
-        .str.replace(".", "", regex=False)
-        .str.extract(pat=pot_kw_pat)
-        .astype(np.float64)
-    )
-    df["potenza_cv"] = (
-        df["Potenza"]
-        .str.replace(".", "", regex=False)
-        .str.extract(pat=pot_cv_pat)
-        .astype(np.float64)
-    )
+def extract_fields(series, replace, fields, index):
+    """Extracts all the fields of a text column in a single pass, matching only
+    the unique values. The patterns are combined as optional lookaheads, so
+    each field takes the first match of its own pattern"""
+    if series is None:
+        return pd.DataFrame(np.nan, index=index, columns=list(fields))
 
-    df["Peso_a_vuoto_kg"] = (
-        df["Peso_a_vuoto_kg"]
-        .str.replace(".", "", regex=False)
-        .str.extract(pat=weight_kg_pat)
-        .astype(np.float64)
-    )
-    df["Emissioni_CO2_gKm"] = (
-        df["Emissioni_CO2_gKm"]
-        .str.replace(".", "", regex=False)
-        .str.extract(pat=emis_gkm_comb_pat)
-        .astype(np.float64)
-    )
-    df["garanzia_mesi"] = (
-        df["garanzia_mesi"].str.extract(pat=garanzia_mesi_pat).astype(np.float64)
-    )
-
-    df["Consumo_comb_L100km"] = (
-        df["Consumo_di_carburante_L100km"]
-        .str.replace(",", ".", regex=False)
-        .str.extract(pat=consumo_comb_L100km_pat, expand=False)
-        .astype(np.float64)
-    )
-    df["Consumo_urb_L100km"] = (
-        df["Consumo_di_carburante_L100km"]
-        .str.replace(",", ".", regex=False)
-        .str.extract(pat=consumo_urb_L100km_pat, expand=False)
-        .astype(np.float64)
-    )
-    df["Consumo_extraurb_L100km"] = (
-        df["Consumo_di_carburante_L100km"]
-        .str.replace(",", ".", regex=False)
-        .str.extract(pat=consumo_extraurb_L100km_pat, expand=False)
-        .astype(np.float64)
-    )
-
-    return df
+    codes, uniques = pd.factorize(series)
+    uniques = pd.Series(uniques, dtype=object)
+    if replace:
+        uniques = uniques.str.replace(*replace, regex=False)
+    pattern = "(?s)" + "".join(f"(?=(?:.*?{pat})?)" for pat in fields.values())
+    extracted = uniques.str.extract(pat=pattern).astype(np.float64)
+    extracted.columns = list(fields)
+    # Missing values have code -1, reindexing leaves them NaN
+    extracted = extracted.reindex(codes)
+    extracted.index = index
+    return extracted
 
 
 def replace_values(df):
@@ -240,21 +441,28 @@ def replace_values(df):
     )
 
     # Extract fuel category: Benzina, Diesel, Ibrida, Elettrica, GPL, Metano, Altro
-    df["Carburante"] = df["Carburante"].map(getFuel)
-    df["Carburante"] = np.where(
-        df["Altre_fonti_energetiche"].str.contains("elettr").notnull(),
-        "Ibrida",
-        df["Carburante"],
-    )
+    df["Carburante"] = map_categories(df["Carburante"], getFuel, fuel_categories)
+    if "Altre_fonti_energetiche" in df.columns:
+        df["Carburante"] = df["Carburante"].mask(
+            df["Altre_fonti_energetiche"]
+            .astype(object)
+            .str.contains("elettr")
+            .notnull(),
+            "Ibrida",
+        )
 
     # Extract car body category: Suv/Fuoristrada, Berlina, Station Wagon, City Car, Furgone, Coupe, Cabrio, Altro
-    df["Carrozzeria"] = df["Carrozzeria"].map(getCarBody)
+    df["Carrozzeria"] = map_categories(
+        df["Carrozzeria"], getCarBody, car_body_categories
+    )
 
     # Boolean columns: Only Owner, Certified Checks
     df["Tagliandi_certificati"] = np.where(
         df["Tagliandi_certificati"] == "Sì", True, False
     )
-    df["unico_proprietario"] = np.where(df["unico_proprietario"] < 1.1, True, False)
+    df["unico_proprietario"] = np.where(
+        pd.to_numeric(df["unico_proprietario"], errors="coerce") < 1.1, True, False
+    )
 
     # Replace 4x4 with Integrale (wheel driven)
     df["Trazione"] = df["Trazione"].replace(regex="4x4", value="Integrale")
@@ -262,15 +470,86 @@ def replace_values(df):
     return df
 
 
+def map_categories(series, classifier, categories):
+    "Classifies only the unique values of a column, returns a fixed Categorical"
+    codes, uniques = pd.factorize(series)
+    # Missing values have code -1 and pick the class of NaN, appended last
+    classes = [classifier(value) for value in uniques] + [classifier(np.nan)]
+    class_codes = pd.Categorical(classes, categories=categories).codes
+    return pd.Series(
+        pd.Categorical.from_codes(class_codes[codes], categories=categories),
+        index=series.index,
+    )
+
+
 def clean_data(df):
     df = edit_index_columns(df)
     df = add_missing_columns(df)
     df = extract_text_data(df)
     df = replace_values(df)
     df = drop_columns(df)
+    df = apply_main_dtypes(df)
     return df
 
 
+def clean_target(target):
+    "Reads and cleans a target batch, returning the error instead of raising it"
+    try:
+        df = read_batch(os.path.join("..", "data", target))
+        return clean_data(df), None
+    except Exception as e:
+        return None, str(e) or repr(e)
+
+
+def iter_clean_targets(targets, pool=None, window=1):
+    """Cleans the target batches, yielding their cleaning results in order.
+    With a pool, up to window batches are cleaned ahead in parallel, so that
+    the cleaned batches waiting to be appended stay bounded"""
+    if pool is None:
+        yield from map(clean_target, targets)
+        return
+    targets = iter(targets)
+    pending = deque(pool.submit(clean_target, tar) for tar in islice(targets, window))
+    while pending:
+        result = pending.popleft().result()
+        for tar in islice(targets, 1):
+            pending.append(pool.submit(clean_target, tar))
+        yield result
+
+
+def clean_chunk(df):
+    "Cleans a chunk of a target batch, returning the error instead of raising it"
+    try:
+        return clean_data(df), None
+    except Exception as e:
+        return None, str(e) or repr(e)
+
+
+def iter_clean_chunks(target, chunksize, pool=None, window=1):
+    """Cleans a target batch chunk by chunk, yielding the name of the dataset
+    part of each chunk and its cleaning result in order. With a pool, up to
+    window chunks are read ahead and cleaned in parallel"""
+    stem = os.path.splitext(target)[0]
+    pending = deque()
+    try:
+        chunks = iter_batch_chunks(os.path.join("..", "data", target), chunksize)
+        for ii, chunk in enumerate(chunks):
+            part = f"{stem}-{ii:05d}"
+            if pool is None:
+                yield part, clean_chunk(chunk)
+                continue
+            pending.append((part, pool.submit(clean_chunk, chunk)))
+            if len(pending) >= window:
+                part, future = pending.popleft()
+                yield part, future.result()
+    except Exception as e:
+        pending.append((stem, None))
+        error = str(e) or repr(e)
+    while pending:
+        part, future = pending.popleft()
+        yield part, future.result() if future else (None, error)
+
+
 def getFuel(fuelString):
     if not isinstance(fuelString, str):
         return "Altro"
@@ -342,6 +621,29 @@ if __name__ == "__main__":
         help="Refresh the full dataset",
         action="store_true",
     )
+    parser.add_argument(
+        "--drop-near-duplicates",
+        "-n",
+        dest="drop_near_duplicates",
+        help="Drop the listings of cars already in the dataset under another URL, "
+        "by default they are only reported",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        dest="jobs",
+        help="Number of batches cleaned in parallel processes",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--chunksize",
+        "-c",
+        dest="chunksize",
+        help="Clean the batches in chunks of listings, bounding the memory used",
+        type=int,
+    )
     parser.add_argument(
         "--debug", "-d", dest="debug", help="Enable debug mode", action="store_true"
     )
@@ -349,45 +651,95 @@ if __name__ == "__main__":
     args = parser.parse_args()
     target = args.target
     refresh = args.refresh
+    drop_near_duplicates = args.drop_near_duplicates
+    jobs = args.jobs
+    chunksize = args.chunksize
     db = args.debug
 
     # Check/Create folders for results
     initWSCleaner()
     if refresh:
         added_batches = []
-        df_main = pd.DataFrame(columns=main_columns)
-        df_main.index.name = "url"
     else:
         with open(path_to_added_batches) as file:
             added_batches = json.load(file)
-        df_main = pd.read_parquet(path_to_full_dataset)
 
     # Getting target list
     targets = getTargets(target, added_batches)
-    if not targets:
+    if targets:
+        print(f"Target batches: {targets}")
+    if refresh and targets:
+        reset_full_dataset()
+        if os.path.exists(path_to_duplicates_report):
+            os.remove(path_to_duplicates_report)
+    index = DatasetIndex()
+    price_history = PriceHistory()
+    sightings_files = [
+        file for file in get_sightings_files() if not price_history.has_sightings(file)
+    ]
+    if not targets and not sightings_files:
         print("No targets!")
+        check_serving_export()
         exit()
-    print(f"Target batches: {targets}")
-
-    # Processing target datasets
-    for ii, tar in enumerate(targets):
-        df = pd.read_csv(os.path.join("..", "data", tar), sep=";", index_col="url")
-        print(f"Processing dataset {tar} ({ii+1}/{len(targets)})", end="\r")
-        try:
-            df = clean_data(df)
-            added_batches.append(tar)
-        except Exception as e:
-            print(f"Error in dataset {tar}: {e}")
-            continue
-        df_main = pd.concat([df_main, df])
-
-    # Dropping duplicates
-    df_main = df_main[~df_main.index.duplicated(keep="first")]
+
+    # Processing target datasets, each one is appended as new dataset parts:
+    # a part for each batch, or for each chunk of listings with chunksize.
+    # Batches or chunks are cleaned in parallel but appended in order
+    with ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext() as pool:
+        if chunksize:
+            cleaned_targets = (
+                iter_clean_chunks(tar, chunksize, pool, 2 * jobs) for tar in targets
+            )
+        else:
+            cleaned = iter_clean_targets(targets, pool, 2 * jobs)
+            cleaned_targets = ([(tar, result)] for tar, result in zip(targets, cleaned))
+        for ii, (tar, cleaned_parts) in enumerate(zip(targets, cleaned_targets)):
+            print(f"Processing dataset {tar} ({ii+1}/{len(targets)})", end="\r")
+            # Parts left by an interrupted run are written again
+            remove_batch_parts(tar)
+            index.remove_batch(tar)
+            reports = []
+            for part, (df, error) in cleaned_parts:
+                if error:
+                    print(f"Error in dataset {tar}: {error}")
+                    # Batches are added whole, the chunks already written are removed
+                    remove_batch_parts(tar)
+                    index.remove_batch(tar)
+                    break
+                # Prices are tracked for every sighting, also of the duplicates
+                price_history.record(df)
+                # Dropping the listings already in the dataset, by URL or content
+                df, duplicates = index.filter_new(
+                    df, get_fingerprints(df), tar, drop_near_duplicates
+                )
+                if len(duplicates) > 0:
+                    reports.append(duplicates)
+                if len(df) > 0:
+                    write_dataset_part(df, part)
+                index.update(df.index, tar, get_fingerprints(df))
+            else:
+                # Reported once the batch is added, as its parts
+                if reports:
+                    duplicates = pd.concat(reports, ignore_index=True)
+                    save_duplicates_report(duplicates)
+                    print(
+                        f"Duplicates in dataset {tar}: "
+                        f"{sum(duplicates['kind'] == 'exact')} exact, "
+                        f"{sum(duplicates['kind'] == 'near')} near"
+                    )
+                added_batches.append(tar)
+                save_added_batches(added_batches)
 
     print("\nAll targets processed")
-    print(f"Main dataset now contains {len(df_main)} records")
-    # Saving results
-    if len(targets) > 0:
-        df_main.to_parquet(path_to_full_dataset, index=True)
-        with open(path_to_added_batches, "w") as file:
-            json.dump(added_batches, file)
+    # Prices of the visited cars are recorded after the batches listing them
+    if sightings_files:
+        changes = sum(
+            price_history.record_sightings(file, read_price_sightings(file))
+            for file in sightings_files
+        )
+        print(
+            f"{changes} price changes found in {len(sightings_files)} sightings files"
+        )
+    print(f"Main dataset now contains {len(index)} records")
+    print(f"Price history now contains {len(price_history)} prices")
+    check_serving_export()
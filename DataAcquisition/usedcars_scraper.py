@@ -1,12 +1,20 @@
 from bs4 import BeautifulSoup, SoupStrainer
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import itertools
 import argparse
-import urllib.request
+import urllib.parse
+import threading
+import time
 import json
 from datetime import datetime
 import regex as re
 import os
-import pandas as pd
 from dotenv import load_dotenv
+from visited_store import VisitedStore
+from scraper_session import ScraperSession
+from batch_writer import BatchWriter
+from price_history import path_to_price_sightings, save_price_sightings
 
 # Load the url of the used cars website
 load_dotenv()
@@ -34,50 +42,160 @@ pattern_vendor_location = re.compile(
 PRICE_TAG = "PriceInfo_price__JPzpT"  # Tag of the Div containing the price
 
 
+class HostRateLimiter:
+    "Spaces out requests to the same host, shared by all the worker threads"
+
+    def __init__(self, rate):
+        # rate is the max number of requests per second per host, 0 disables it
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+rate_limiter = HostRateLimiter(5.0)
+session = ScraperSession()
+
+
+def fetch_page(url, conditional=False):
+    "Downloads a page respecting the per-host rate limit"
+    rate_limiter.wait(url)
+    return session.get(url, conditional)
+
+
 def initWS():
     if not used_cars_website:
         print("Used cars website URL not found")
         exit()
     if not os.path.isdir(os.path.join("..", "data")):
         os.mkdir(os.path.join("..", "data"))
-    path_to_visited_urls = os.path.join("..", "data", "visited_urls.json")
-    if not os.path.isfile(path_to_visited_urls):
-        with open(path_to_visited_urls, "w") as file:
-            json.dump([], file)
 
 
-def get_car_URLs(country, numpages, offsetpag, db=False):
+def get_search_URL(country, page):
+    return (
+        used_cars_website
+        + "/lst?sort=age&desc=1&ustate=N%2CU&size=20&page="
+        + str(page)
+        + "&cy="
+        + countries[country]
+        + "&atype=C"
+    )
+
+
+def iter_page_car_URLs(page_html):
+    "Yields the cars detail URLs linked by a search results page"
+    only_car_links = SoupStrainer("a", href=lambda href: href and "/annunci/" in href)
+    soup = BeautifulSoup(page_html, "lxml", parse_only=only_car_links)
+    for link in soup.find_all("a"):
+        yield link.get("href")
+
+
+def iter_page_car_prices(page_html):
+    "Yields the cars detail URLs of a search results page with the price shown"
+    try:
+        next_data = get_next_data(page_html)
+    except ValueError:
+        return
+    listings = iter_json_objects(
+        next_data,
+        lambda node: isinstance(node.get("url"), str)
+        and "/annunci/" in node["url"]
+        and "price" in node,
+    )
+    for listing in listings:
+        price = listing["price"]
+        if isinstance(price, dict):
+            price = price.get("priceFormatted")
+        if price is not None:
+            yield listing["url"], json_to_text(price)
+
+
+def get_car_URLs(
+    country,
+    numpages,
+    offsetpag,
+    db=False,
+    visited_urls=(),
+    workers=4,
+    sightings=None,
+    price_pages=0,
+):
+    """Returns the new cars detail URLs found in the search results, in page
+    order. The prices shown for the visited cars are appended to sightings,
+    reading up to price_pages pages of visited cars before stopping"""
     car_URLs = []
-    # Iterating all the Web Pages within the search results
-    for page in range(1 + offsetpag, 1 + offsetpag + numpages):
-        try:
-            url = (
-                used_cars_website
-                + "/lst?sort=age&desc=1&ustate=N%2CU&size=20&page="
-                + str(page)
-                + "&cy="
-                + countries[country]
-                + "&atype=C"
-            )
-            only_a_tags = SoupStrainer("a")
-            soup = BeautifulSoup(
-                urllib.request.urlopen(url).read(), "lxml", parse_only=only_a_tags
-            )
-        except Exception as e:
-            if db:
-                print(f"Error page {page}: " + str(e) + " " * 50, end="\r")
-            pass
-        for link in soup.find_all("a"):
-            if r"/annunci/" in str(link.get("href")):
-                car_URLs.append(link.get("href"))
+    seen_URLs = set()
+    pages = iter(range(1 + offsetpag, 1 + offsetpag + numpages))
+    # Search pages are downloaded concurrently but consumed in order, so that
+    # the crawl can stop at the first page made only of already visited cars
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit_page(page):
+            # Search pages are revalidated against the copy of the previous run
+            search_URL = get_search_URL(country, page)
+            return page, executor.submit(fetch_page, search_URL, conditional=True)
+
+        pending = deque(submit_page(page) for page in itertools.islice(pages, workers))
+        visited_pages = 0
+        while pending:
+            page, future = pending.popleft()
+            try:
+                page_html = future.result()
+            except Exception as e:
+                if db:
+                    print(f"Error page {page}: " + str(e) + " " * 50, end="\r")
+                page_html = None
+
+            if page_html is not None:
+                if sightings is not None:
+                    date = str(datetime.now())
+                    for car, price in iter_page_car_prices(page_html):
+                        if car in visited_urls:
+                            sightings.append((car, country, date, price))
+                found, already_visited = 0, 0
+                for car in iter_page_car_URLs(page_html):
+                    found += 1
+                    if car in visited_urls:
+                        already_visited += 1
+                    elif car not in seen_URLs:
+                        seen_URLs.add(car)
+                        car_URLs.append(car)
+                # Results are sorted by age: following pages are already visited
+                if found and already_visited == found:
+                    visited_pages += 1
+                if visited_pages > price_pages:
+                    if db:
+                        print(f"Page {page} already visited, stopping search")
+                    for _, future in pending:
+                        future.cancel()
+                    break
+
+            page = next(pages, None)
+            if page is not None:
+                pending.append(submit_page(page))
     return car_URLs
 
 
-def get_car_dict(URL, db=False):
+def get_car_dict(URL, country, db=False):
+    return parse_car_page(fetch_page(used_cars_website + URL), URL, country, db)
+
+
+def parse_car_page_soup(page_html, URL, country, db=False):
+    "Reference parser of a car detail page, builds the full BeautifulSoup tree"
     car_dict = {}
     car_dict["country"] = country
     car_dict["date"] = str(datetime.now())
-    car = BeautifulSoup(urllib.request.urlopen(used_cars_website + URL).read(), "lxml")
+    car = BeautifulSoup(page_html, "lxml")
 
     # Manufacturer data
     manufacturer_res = re.findall(
@@ -154,21 +272,226 @@ def get_car_dict(URL, db=False):
     return car_dict
 
 
+def get_next_data(page_html):
+    "Decodes the __NEXT_DATA__ JSON blob embedded in a page"
+    start = page_html.find(b'id="__NEXT_DATA__"')
+    if start < 0:
+        raise ValueError("__NEXT_DATA__ not found")
+    start = page_html.index(b">", start) + 1
+    end = page_html.index(b"</script>", start)
+    return json.loads(page_html[start:end])
+
+
+def find_json_object(data, is_target):
+    "Depth-first search of the first JSON object satisfying is_target"
+    return next(iter_json_objects(data, is_target), None)
+
+
+def iter_json_objects(data, is_target):
+    """Depth-first search of the JSON objects satisfying is_target, in order.
+    The objects found are not searched further"""
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if is_target(node):
+                yield node
+                continue
+            stack.extend(reversed(list(node.values())))
+        elif isinstance(node, list):
+            stack.extend(reversed(node))
+
+
+def json_to_text(value):
+    "Formats a JSON value as it appears in the page source, without quotes"
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def is_detail_tag(name, attrs):
+    "Selects the tags read from the DOM by parse_car_page"
+    if name in ("dt", "dd"):
+        return True
+    classes = attrs.get("class", "").split()
+    if name == "span":
+        return PRICE_TAG in classes
+    if name == "div":
+        return "cldt-vendor-contact-box" in classes
+    return False
+
+
+only_detail_tags = SoupStrainer(is_detail_tag)
+manufacturer_keys = [
+    "makeId",
+    "modelOrModelLineId",
+    "make",
+    "model",
+    "modelVersionInput",
+]
+location_keys = ["countryCode", "zip", "city", "street"]
+
+
+def parse_car_page(page_html, URL, country, db=False):
+    "Fast parser of a car detail page, same output of parse_car_page_soup"
+    # Manufacturer and location are read from the __NEXT_DATA__ JSON, the DOM
+    # is built only for the tags selected by is_detail_tag
+    car_dict = {}
+    car_dict["country"] = country
+    car_dict["date"] = str(datetime.now())
+    next_data = get_next_data(page_html)
+
+    # Manufacturer data
+    manufacturer = find_json_object(
+        next_data, lambda node: all(key in node for key in manufacturer_keys)
+    )
+    if manufacturer:
+        (
+            car_dict["makeId"],
+            car_dict["modelOrModelLineId"],
+            car_dict["maker"],
+            car_dict["model"],
+            car_dict["modelVersionInput"],
+        ) = (json_to_text(manufacturer[key]) for key in manufacturer_keys)
+    else:
+        (
+            car_dict["makeId"],
+            car_dict["modelOrModelLineId"],
+            car_dict["maker"],
+            car_dict["model"],
+            car_dict["modelVersionInput"],
+        ) = ("NaN", "NaN", "NaN", "NaN", "NaN")
+        if db:
+            print(f"Not found manufacturer in URL {URL}")
+
+    # Main data attributes
+    car = BeautifulSoup(page_html, "lxml", parse_only=only_detail_tags)
+    for key, value in zip(car.find_all("dt"), car.find_all("dd")):
+        items = value.find_all("li")
+        if items:  # concatenate list of item
+            car_dict[key.text.replace("\n", "")] = ";".join(
+                [itm.text.replace("\n", "") for itm in items]
+            )
+        else:
+            car_dict[key.text.replace("\n", "")] = value.text.replace("\n", "")
+
+    car_dict["dealer"] = (
+        car.find("div", attrs={"data-vendor-type": "dealer"}) is not None
+    )
+    car_dict["privateSeller"] = (
+        car.find("div", attrs={"data-vendor-type": "privateseller"}) is not None
+    )
+    car_dict["price"] = car.find("span", attrs={"class": PRICE_TAG}).text
+
+    # Vendor Location Data
+    location = find_json_object(
+        next_data,
+        lambda node: isinstance(node.get("location"), dict)
+        and all(key in node["location"] for key in location_keys),
+    )
+    if location:
+        (
+            car_dict["countryCode"],
+            car_dict["zip"],
+            car_dict["city"],
+            car_dict["street"],
+        ) = (json_to_text(location["location"][key]) for key in location_keys)
+    else:
+        (
+            car_dict["countryCode"],
+            car_dict["zip"],
+            car_dict["city"],
+            car_dict["street"],
+        ) = ("NaN", "NaN", "NaN", "NaN")
+        if db:
+            print(f"Not found vendor location in URL {URL}")
+
+    return car_dict
+
+
+def get_countries_car_URLs(
+    country_pages,
+    offsetpag,
+    db=False,
+    visited_urls=(),
+    workers=4,
+    sightings=None,
+    price_pages=0,
+):
+    "Harvests the search results of several countries concurrently"
+    car_URLs = {}
+    with ThreadPoolExecutor(max_workers=len(country_pages)) as executor:
+        futures = {
+            country: executor.submit(
+                get_car_URLs,
+                country,
+                numpages,
+                offsetpag,
+                db,
+                visited_urls,
+                workers,
+                sightings,
+                price_pages,
+            )
+            for country, numpages in country_pages.items()
+        }
+        # Results are merged keeping the order of the countries
+        for country, future in futures.items():
+            for car in future.result():
+                car_URLs.setdefault(car, country)
+    return car_URLs
+
+
+def iter_cars_dicts(car_URLs, workers=8, db=False):
+    "Downloads the cars detail pages concurrently, yielding them in order"
+    car_URLs = iter(car_URLs.items())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # At most a few pages per worker are kept in memory
+        pending = deque(
+            (URL, executor.submit(get_car_dict, URL, country, db))
+            for URL, country in itertools.islice(car_URLs, 2 * workers)
+        )
+        ii = 0
+        while pending:
+            URL, future = pending.popleft()
+            ii += 1
+            if ii % 20 == 0:
+                print(f"Processing car {ii}", end="\r")
+            try:
+                yield URL, future.result()
+            except Exception as e:
+                if db:
+                    print(f"Error car {ii}: " + str(e) + " " * 10)
+            for URL, country in itertools.islice(car_URLs, 1):
+                pending.append((URL, executor.submit(get_car_dict, URL, country, db)))
+
+
+def country_budget(value):
+    "Parses a COUNTRY[:NUMPAGES] command line value"
+    country, _, numpages = value.partition(":")
+    if country not in countries:
+        raise argparse.ArgumentTypeError(
+            f"invalid country {country!r} (choose from {', '.join(countries)})"
+        )
+    if numpages and not numpages.isdigit():
+        raise argparse.ArgumentTypeError(f"invalid number of pages {numpages!r}")
+    return country, int(numpages) if numpages else None
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--country",
         "-c",
         dest="country",
-        help="Country where to search cars",
-        default="Italy",
-        choices=countries.keys(),
+        help="Countries where to search cars, each as COUNTRY[:NUMPAGES]",
+        nargs="+",
+        type=country_budget,
+        default=[("Italy", None)],
     )
     parser.add_argument(
         "--numpages",
         "-n",
         dest="numpages",
-        help="Number of pages to retrieve",
+        help="Number of pages to retrieve for countries without their own",
         type=int,
         default=20,
     )
@@ -180,56 +503,103 @@ if __name__ == "__main__":
         type=int,
         default=0,
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        dest="workers",
+        help="Number of detail pages downloaded concurrently",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--rate",
+        "-r",
+        dest="rate",
+        help="Max requests per second to the website (0 = no limit)",
+        type=float,
+        default=5.0,
+    )
+    parser.add_argument(
+        "--chunksize",
+        dest="chunksize",
+        help="Number of listings saved to disk at once",
+        type=int,
+        default=50,
+    )
+    parser.add_argument(
+        "--price-pages",
+        "-p",
+        dest="price_pages",
+        help="Number of pages of visited cars read for their prices before stopping",
+        type=int,
+        default=5,
+    )
     parser.add_argument(
         "--debug", "-d", dest="debug", help="Enable debug mode", action="store_true"
     )
     args = parser.parse_args()
 
-    country = args.country
     numpages = args.numpages
+    country_pages = {
+        country: numpages if country_numpages is None else country_numpages
+        for country, country_numpages in args.country
+    }
     offsetpag = args.offsetpag
+    workers = args.workers
+    chunksize = args.chunksize
+    price_pages = args.price_pages
+    rate_limiter = HostRateLimiter(args.rate)
     db = args.debug
 
     # Check/Create folders for results
     print("Scraper started")
     initWS()
-    path_to_visited_urls = os.path.join("..", "data", "visited_urls.json")
+    session = ScraperSession(pool_size=workers * (len(country_pages) + 1))
+    session.load_cache()
 
     # In Debug mode not skip already processed cars
     if db:
-        visited_urls = []
-        filesavename = re.sub("[.,:,-, ]", "_", str(datetime.now())) + "_db.csv"
+        visited_urls = set()
+        filesavename = re.sub("[.,:,-, ]", "_", str(datetime.now())) + "_db.parquet"
     else:
-        with open(path_to_visited_urls) as file:
-            visited_urls = json.load(file)
-        filesavename = re.sub("[.,:,-, ]", "_", str(datetime.now())) + ".csv"
+        visited_urls = VisitedStore()
+        num_imported = visited_urls.import_json()
+        if num_imported:
+            print(f"Imported {num_imported} visited URLs from JSON")
+        filesavename = re.sub("[.,:,-, ]", "_", str(datetime.now())) + ".parquet"
 
-    # Results container
-    multiple_cars_dict = {}
     fullsavename = os.path.join("..", "data", filesavename)
 
+    # Listings of an interrupted run are kept, the run continues on its batch
+    writer = None
+    if not db:
+        writer = BatchWriter.resume(os.path.join("..", "data"), visited_urls, chunksize)
+        if writer:
+            print(f"Resuming batch {writer.path} ({writer.count} cars saved)")
+    if writer is None:
+        writer = BatchWriter(fullsavename, visited_urls, chunksize)
+
     # Getting car detail URL from all pages
-    car_URLs = get_car_URLs(country, numpages, offsetpag, db)
-    car_URLs_unique = [car for car in list(set(car_URLs)) if car not in visited_urls]
+    # Visited cars are not downloaded again, their prices are read from the
+    # search results and added to the price history by the cleaner
+    sightings = []
+    car_URLs_unique = get_countries_car_URLs(
+        country_pages, offsetpag, db, visited_urls, workers, sightings, price_pages
+    )
     print(f"{len(car_URLs_unique)} cars to be processed.")
+    if sightings and not db:
+        save_price_sightings(
+            sightings, os.path.join(path_to_price_sightings, filesavename)
+        )
+        print(f"{len(sightings)} prices of visited cars saved")
 
-    # Iterating cars detail Web Pages
-    for ii, URL in enumerate(car_URLs_unique):
-        if (ii + 1) % 20 == 0:
-            print(f"Processing car {ii+1}", end="\r")
-        try:
-            car_dict = get_car_dict(URL, db)
-            multiple_cars_dict[URL] = car_dict
-            visited_urls.append(URL)
-        except Exception as e:
-            if db:
-                print(f"Error car {ii+1}: " + str(e) + " " * 10)
+    # Iterating cars detail Web Pages, saving results as they come
+    try:
+        for URL, car_dict in iter_cars_dicts(car_URLs_unique, workers, db):
+            writer.write(URL, car_dict)
+    except KeyboardInterrupt:
+        writer.flush()
+        raise
     print("\nAll cars processed")
-
-    # Saving results
-    if len(multiple_cars_dict) > 0:
-        df = pd.DataFrame(multiple_cars_dict).T
-        df.to_csv(fullsavename, sep=";", index_label="url")
-        if not db:
-            with open(path_to_visited_urls, "w") as file:
-                json.dump(visited_urls, file)
+    session.save_cache()
+    writer.close()
@@ -0,0 +1,68 @@
+import sqlite3
+import threading
+import json
+import os
+
+path_to_visited_store = os.path.join("..", "data", "visited_urls.sqlite")
+path_to_visited_json = os.path.join("..", "data", "visited_urls.json")
+
+
+class VisitedStore:
+    "Persistent set of the visited cars URLs, backed by an indexed SQLite table"
+
+    def __init__(self, path=path_to_visited_store):
+        # The store is shared by the scraper threads, queries are serialized
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS visited (url TEXT PRIMARY KEY) WITHOUT ROWID"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS imported (path TEXT PRIMARY KEY)"
+            )
+
+    def __contains__(self, url):
+        with self.lock:
+            return (
+                self.connection.execute(
+                    "SELECT 1 FROM visited WHERE url = ?", (url,)
+                ).fetchone()
+                is not None
+            )
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM visited").fetchone()[0]
+
+    def update(self, urls):
+        "Appends the given URLs, committing them in a single transaction"
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO visited (url) VALUES (?)",
+                ((url,) for url in urls),
+            )
+
+    def import_json(self, path=path_to_visited_json):
+        "Imports once a legacy visited_urls.json list"
+        if not os.path.isfile(path):
+            return 0
+        imported = self.connection.execute(
+            "SELECT 1 FROM imported WHERE path = ?", (os.path.basename(path),)
+        ).fetchone()
+        if imported:
+            return 0
+        with open(path) as file:
+            urls = json.load(file)
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO visited (url) VALUES (?)",
+                ((url,) for url in urls),
+            )
+            self.connection.execute(
+                "INSERT INTO imported (path) VALUES (?)", (os.path.basename(path),)
+            )
+        return len(urls)
+
+    def close(self):
+        self.connection.close()
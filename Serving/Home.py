@@ -1,10 +1,14 @@
 import streamlit as st
+import serving_helpers
 
 st.set_page_config(
     page_title="Home",
     page_icon="🏠",
 )
 
+# Loads the model and the catalog while the page is read
+serving_helpers.start_warm_up()
+
 st.write("# Welcome! 👋")
 
 st.markdown(
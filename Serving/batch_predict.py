@@ -0,0 +1,161 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import io
+import json
+import sys
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import inference
+
+
+def score_chunks(model, chunks):
+    "Yields the chunks of cars with their predicted price"
+    for chunk in chunks:
+        yield chunk.assign(predicted_price=inference.predict(model, chunk))
+
+
+def to_output_types(chunk):
+    """Casts the columns of a scored chunk to types that do not depend on the
+    values of the chunk: numbers and the numerical features to float64, the
+    other columns to strings except dates"""
+    chunk = chunk.copy()
+    for col, dtype in chunk.dtypes.items():
+        if col in inference.numerical_columns or (
+            pd.api.types.is_numeric_dtype(dtype)
+            and not pd.api.types.is_bool_dtype(dtype)
+        ):
+            chunk[col] = pd.to_numeric(chunk[col], errors="coerce").astype("float64")
+        elif not pd.api.types.is_datetime64_any_dtype(dtype):
+            chunk[col] = chunk[col].astype("string")
+    return chunk
+
+
+def write_predictions(chunks, output):
+    """Writes the scored chunks as they come, to a Parquet or CSV file or to
+    stdout as CSV. Returns the number of cars scored"""
+    num_rows = 0
+    parquet_writer = None
+    for chunk in chunks:
+        if output.endswith(".parquet"):
+            table = pa.Table.from_pandas(to_output_types(chunk), preserve_index=False)
+            if parquet_writer is None:
+                parquet_writer = pq.ParquetWriter(output, table.schema)
+            # Columns missing in the first chunk are typed on its nulls
+            parquet_writer.write_table(table.cast(parquet_writer.schema))
+        else:
+            chunk.to_csv(
+                sys.stdout if output == "-" else output,
+                mode="w" if num_rows == 0 else "a",
+                header=num_rows == 0,
+                index=False,
+            )
+        num_rows += len(chunk)
+    if parquet_writer is not None:
+        parquet_writer.close()
+    return num_rows
+
+
+def make_handler(model, chunksize):
+    class PredictionHandler(BaseHTTPRequestHandler):
+        "Scores the cars posted to /predict, as a JSON list or CSV"
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                if self.headers.get("Content-Type", "").startswith("text/csv"):
+                    chunks = inference.iter_cars_chunks(io.BytesIO(body), chunksize)
+                else:
+                    cars = pd.DataFrame.from_records(json.loads(body))
+                    chunks = inference.iter_frame_chunks(cars, chunksize)
+                start = time.perf_counter()
+                prices = [
+                    price
+                    for chunk in chunks
+                    for price in inference.predict(model, chunk).tolist()
+                ]
+                elapsed = time.perf_counter() - start
+            except Exception as e:
+                self.send_error(400, str(e))
+                return
+
+            content = json.dumps({"predicted_price": prices}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            print(f"Scored {len(prices)} cars ({len(prices) / elapsed:.0f} rows/sec)")
+
+    return PredictionHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input",
+        "-i",
+        dest="input",
+        help="CSV, JSON (.json), JSON lines (.jsonl) or Parquet file of the cars to "
+        "evaluate, - for CSV from stdin",
+        default="-",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        dest="output",
+        help="CSV or Parquet file of the predictions, - for CSV to stdout",
+        default="-",
+    )
+    parser.add_argument(
+        "--chunksize",
+        "-c",
+        dest="chunksize",
+        help="Number of cars scored at once",
+        type=int,
+        default=10000,
+    )
+    parser.add_argument(
+        "--serve",
+        "-s",
+        dest="serve",
+        help="Serve the predictions on a local HTTP endpoint, POST /predict",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--port",
+        "-p",
+        dest="port",
+        help="Port of the HTTP endpoint",
+        type=int,
+        default=8000,
+    )
+
+    args = parser.parse_args()
+    model = inference.load_model()
+
+    if args.serve:
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", args.port), make_handler(model, args.chunksize)
+        )
+        print(f"Serving predictions on http://127.0.0.1:{args.port}/predict")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+        exit()
+
+    start = time.perf_counter()
+    chunks = inference.iter_cars_chunks(
+        sys.stdin if args.input == "-" else args.input, args.chunksize
+    )
+    num_rows = write_predictions(score_chunks(model, chunks), args.output)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Scored {num_rows} cars in {elapsed:.1f} s ({num_rows / elapsed:.0f} rows/sec)",
+        file=sys.stderr,
+    )
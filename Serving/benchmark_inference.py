@@ -0,0 +1,121 @@
+from datetime import datetime
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import inference
+
+# Cars valued in the benchmark when no input file is given, with the
+# features left empty by the Car Evaluator
+sample_cars = [
+    {
+        "Carburante": "Benzina",
+        "Carrozzeria": "City Car",
+        "Chilometraggio": 40000,
+        "Cilindrata_cm3": 1242,
+        "Tipo_di_cambio": "Manuale",
+        "Tipo_di_veicolo": "Usato",
+        "Trazione": "Anteriore",
+        "maker": "Fiat",
+        "model": "Panda",
+        "potenza_cv": 69,
+        "age_years": 4.5,
+    },
+    {
+        "Carburante": "Diesel",
+        "Carrozzeria": "SUV/Fuoristrada",
+        "Chilometraggio": 120000,
+        "Cilindrata_cm3": 1995,
+        "Tipo_di_cambio": "Automatico",
+        "Tipo_di_veicolo": "Usato",
+        "Trazione": "Integrale",
+        "maker": "BMW",
+        "model": "X3",
+        "potenza_cv": 190,
+        "age_years": 6.2,
+    },
+    {
+        "Carburante": "Ibrida",
+        "Carrozzeria": "Berlina",
+        "Chilometraggio": 15000,
+        "Cilindrata_cm3": 1490,
+        "Tipo_di_cambio": "Automatico",
+        "Tipo_di_veicolo": "Usato",
+        "Trazione": "Anteriore",
+        "maker": "Toyota",
+        "model": "Unknown Model",
+        "potenza_cv": 116,
+        "age_years": 1.0,
+    },
+]
+
+
+def time_predictions(predict, cars, repeat):
+    "Returns the latencies in ms of the single car predictions, and the last ones"
+    latencies = []
+    for _ in range(repeat):
+        predictions = []
+        for car in cars:
+            start = time.perf_counter()
+            predictions.append(predict(car))
+            latencies.append((time.perf_counter() - start) * 1e3)
+    return np.array(latencies), np.array(predictions)
+
+
+def predict_with_pipeline(model, car):
+    "The path of the Car Evaluator, a one row DataFrame through the pipeline"
+    inputs = {key: [value] for key, value in car.items()}
+    return inference.predict(model, pd.DataFrame.from_dict(inputs))[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input",
+        "-i",
+        dest="input",
+        help="CSV, JSON, JSON lines or Parquet file of cars to value, one at a time",
+    )
+    parser.add_argument(
+        "--cars",
+        "-n",
+        dest="cars",
+        help="Number of cars read from the input file",
+        type=int,
+        default=200,
+    )
+    parser.add_argument(
+        "--repeat",
+        dest="repeat",
+        help="Number of timed runs over the cars",
+        type=int,
+        default=20,
+    )
+    args = parser.parse_args()
+
+    if args.input:
+        df = next(inference.iter_cars_chunks(args.input, args.cars))
+        cars = [
+            {key: value for key, value in car.items() if not pd.isna(value)}
+            for car in df.to_dict("records")
+        ]
+    else:
+        cars = sample_cars
+
+    print(f"Benchmark started at {datetime.now()} on {len(cars)} cars")
+    model = inference.load_model()
+    compiled_model = inference.CompiledModel(model)
+
+    results = {}
+    for name, predict in [
+        ("Pipeline", lambda car: predict_with_pipeline(model, car)),
+        ("Compiled", compiled_model.predict_one),
+    ]:
+        latencies, predictions = time_predictions(predict, cars, args.repeat)
+        results[name] = predictions
+        print(
+            f"{name:8s} p50 {np.percentile(latencies, 50):.3f} ms, "
+            f"p99 {np.percentile(latencies, 99):.3f} ms"
+        )
+    np.testing.assert_allclose(results["Compiled"], results["Pipeline"], rtol=1e-6)
+    print("Predictions match")
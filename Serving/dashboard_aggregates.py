@@ -0,0 +1,214 @@
+from datetime import datetime
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# Exports the offers and the aggregates read by the Serving app from the
+# dataset written by the cleaner. Run on its own, out of the hourly cleaning
+path_to_dataset = os.path.join("..", "data", "usedcars_dataset.parquet")
+path_to_dashboard_aggregates = os.path.join("..", "data", "dashboard_aggregates")
+# Uncompressed Arrow file of the offers, memory mapped by the Serving processes
+path_to_offers = os.path.join("..", "data", "usedcars_offers.arrow")
+
+# Columns of the offers shown in the app, offers missing any of them are skipped
+data_columns = (
+    "date",
+    "maker",
+    "model",
+    "Anno",
+    "Chilometraggio",
+    "potenza_cv",
+    "Carburante",
+    "Carrozzeria",
+    "Cilindrata_cm3",
+    "Tipo_di_cambio",
+    "Trazione",
+    "price",
+)
+# Features of the models described in the catalog, as inputs of the Car Evaluator
+catalog_features = ["age_years", "Chilometraggio", "potenza_cv"]
+
+
+def get_offers_filter(
+    max_price=1e6, min_price=100, max_cv=1000, max_km=1e6, max_engsize=1e4
+):
+    "Returns the dataset filter of the valid offers, pushed down to the Parquet scan"
+    condition = ds.field(data_columns[0]).is_valid()
+    for col in data_columns[1:]:
+        condition &= ds.field(col).is_valid()
+    return (
+        condition
+        & (ds.field("potenza_cv") >= 0)
+        & (ds.field("potenza_cv") <= max_cv)
+        & (ds.field("Chilometraggio") >= 0)
+        & (ds.field("Chilometraggio") <= max_km)
+        & (ds.field("price") >= min_price)
+        & (ds.field("price") <= max_price)
+        & (ds.field("Cilindrata_cm3") >= 0)
+        & (ds.field("Cilindrata_cm3") <= max_engsize)
+    )
+
+
+def get_aggregates_by_model(data):
+    return (
+        data.groupby(["maker", "model"], observed=True)
+        .agg(
+            model_count=pd.NamedAgg(column="model", aggfunc="count"),
+            price_sum=pd.NamedAgg(column="price", aggfunc="sum"),
+        )
+        .reset_index()
+        .astype({"maker": str, "model": str})
+    )
+
+
+def get_catalog(data, num_makers=40, num_models=30):
+    """Returns the top makers with their top models, by number of offers. Each
+    model has its number of offers and the range of its features, from the 1st
+    to the 99th percentile"""
+    data = data.assign(
+        maker=data["maker"].astype(str),
+        model=data["model"].astype(str),
+        age_years=(data["date"] - data["Anno"]) / np.timedelta64(1, "Y"),
+    )
+    by_model = data.groupby(["maker", "model"])
+    counts = by_model.size().sort_values(ascending=False, kind="stable")
+    lows = by_model[catalog_features].quantile(0.01)
+    highs = by_model[catalog_features].quantile(0.99)
+    maker_counts = (
+        counts.groupby(level="maker").sum().sort_values(ascending=False, kind="stable")
+    )
+
+    catalog = {}
+    for maker, maker_count in maker_counts.head(num_makers).items():
+        models = {}
+        for model, count in counts.loc[maker].head(num_models).items():
+            low, high = lows.loc[(maker, model)], highs.loc[(maker, model)]
+            models[model] = {
+                "count": int(count),
+                "ranges": {
+                    col: [float(low[col]), float(high[col])] for col in catalog_features
+                },
+            }
+        catalog[maker] = {"count": int(maker_count), "models": models}
+    return catalog
+
+
+def get_car_counts_by_year_and_bodytype(data):
+    df = (
+        data.groupby([data["Anno"].dt.year, "Carrozzeria"], observed=True)
+        .size()
+        .reset_index(name="Counts")
+    )
+    return df.rename(columns={"Anno": "Year", "Carrozzeria": "Body Type"}).astype(
+        {"Body Type": str}
+    )
+
+
+def get_car_prices_by_year(data):
+    df = (
+        data.groupby(data["Anno"].dt.year)
+        .agg(
+            q_min=pd.NamedAgg(column="price", aggfunc=lambda x: x.quantile(0.25)),
+            q_max=pd.NamedAgg(column="price", aggfunc=lambda x: x.quantile(0.75)),
+            median=pd.NamedAgg(column="price", aggfunc="median"),
+        )
+        .reset_index()
+    )
+    return df.rename(columns={"Anno": "anno"}).astype({"anno": "int64"})
+
+
+def get_gauges(data):
+    median_age = (data["date"] - data["Anno"]).median() / np.timedelta64(1, "Y")
+    return {
+        "num_offers": len(data),
+        "median_price": float(data["price"].median()),
+        "median_age": median_age,
+    }
+
+
+def read_dashboard_offers(path_to_dataset=path_to_dataset):
+    "Reads the valid offers shown in the dashboard from the dataset"
+    dataset = ds.dataset(path_to_dataset, format="parquet")
+    table = dataset.to_table(columns=list(data_columns), filter=get_offers_filter())
+    return table.to_pandas()
+
+
+def save_offers(data, path=path_to_offers):
+    "Writes the offers as an Arrow IPC file, renamed over the previous one"
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    tmp_path = path + ".tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def save_dashboard_aggregates(data, path=path_to_dashboard_aggregates):
+    """Materializes the aggregates shown in the dashboard, so that Serving
+    reads them instead of computing them from the whole dataset"""
+    if not os.path.isdir(path):
+        os.mkdir(path)
+
+    aggregates = {
+        "by_model": get_aggregates_by_model(data),
+        "by_year_bodytype": get_car_counts_by_year_and_bodytype(data),
+        "prices_by_year": get_car_prices_by_year(data),
+    }
+    for name, df in aggregates.items():
+        tmp_path = os.path.join(path, name + ".parquet.tmp")
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, os.path.join(path, name + ".parquet"))
+
+    summaries = {
+        "gauges": get_gauges(data),
+        "catalog": get_catalog(data),
+    }
+    for name, summary in summaries.items():
+        tmp_path = os.path.join(path, name + ".json.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(summary, file)
+        os.replace(tmp_path, os.path.join(path, name + ".json"))
+
+
+def export_serving_data(path_to_dataset=path_to_dataset):
+    "Exports the offers and the dashboard aggregates, returns the number of offers"
+    offers = read_dashboard_offers(path_to_dataset)
+    save_offers(offers)
+    save_dashboard_aggregates(offers)
+    return len(offers)
+
+
+def is_export_stale(path_to_dataset=path_to_dataset):
+    """Tells if the dataset changed since the offers were exported. Parts are
+    written and removed by renames, which update the mtime of the folder"""
+    if not os.path.isdir(path_to_dataset):
+        return False
+    if not os.path.isfile(path_to_offers):
+        return True
+    return os.path.getmtime(path_to_dataset) > os.path.getmtime(path_to_offers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--force",
+        "-f",
+        dest="force",
+        help="Export the offers also if the dataset did not change",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    if not os.path.isdir(path_to_dataset):
+        print("Dataset not found!")
+        exit()
+    if not args.force and not is_export_stale():
+        print("Serving offers already up to date")
+        exit()
+    print(f"Export started at {datetime.now()}")
+    num_offers = export_serving_data()
+    print(f"{num_offers} offers and their dashboard aggregates exported")
@@ -0,0 +1,318 @@
+from collections import OrderedDict
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from datetime import datetime
+
+path_to_model = os.path.join("..", "Modeling", "models", "XGB_final.joblib")
+
+# Inputs of the model, as filled by the Car Evaluator
+numerical_columns = [
+    "Chilometraggio",
+    "Cilindrata_cm3",
+    "Cilindri",
+    "Consumo_comb_L100km",
+    "Marce",
+    "Peso_a_vuoto_kg",
+    "Porte",
+    "Posti",
+    "age_years",
+    "potenza_cv",
+]
+categorical_columns = [
+    "Carburante",
+    "Carrozzeria",
+    "Tipo_di_cambio",
+    "Tipo_di_veicolo",
+    "Trazione",
+]
+hashed_columns = ["maker", "model"]
+feature_columns = numerical_columns + categorical_columns + hashed_columns
+
+
+def load_model(path=path_to_model):
+    # Imported when needed, loading the model pulls in sklearn and xgboost
+    import joblib
+
+    with open(path, "rb") as model_file:
+        model = joblib.load(model_file)
+    return model
+
+
+def prepare_features(df):
+    """Returns the model inputs of a frame of cars, missing features are left
+    to the model imputers. The age can be given as registration date (Anno)"""
+    features = pd.DataFrame(index=df.index)
+    if "age_years" not in df.columns and "Anno" in df.columns:
+        age = datetime.now() - pd.to_datetime(df["Anno"])
+        df = df.assign(age_years=age / np.timedelta64(1, "Y"))
+    for col in numerical_columns:
+        if col in df.columns:
+            features[col] = pd.to_numeric(df[col], errors="coerce").astype(np.float64)
+        else:
+            features[col] = np.nan
+    for col in categorical_columns:
+        if col in df.columns:
+            features[col] = df[col].astype(object).where(df[col].notna(), np.nan)
+        else:
+            features[col] = np.nan
+    # Hashed features are imputed when None
+    for col in hashed_columns:
+        if col in df.columns:
+            features[col] = df[col].astype(object).where(df[col].notna(), None)
+        else:
+            features[col] = None
+    return features
+
+
+def predict(model, df):
+    "Returns the predicted prices of a frame of cars"
+    return model.predict(prepare_features(df))
+
+
+def iter_cars_chunks(file, chunksize):
+    """Reads the cars to evaluate in chunks, from a Parquet, JSON lines, JSON
+    or CSV file. Streams are read as CSV, the columns of CSV files as text, so
+    that they keep the same type in all the chunks"""
+    name = file if isinstance(file, str) else ""
+    if name.endswith(".parquet"):
+        for record_batch in pq.ParquetFile(file).iter_batches(batch_size=chunksize):
+            yield record_batch.to_pandas()
+    elif name.endswith(".jsonl"):
+        yield from pd.read_json(file, lines=True, chunksize=chunksize)
+    elif name.endswith(".json"):
+        # A list of cars, as posted to the batch endpoint, is read whole
+        with open(file) as json_file:
+            cars = pd.DataFrame.from_records(json.load(json_file))
+        yield from iter_frame_chunks(cars, chunksize)
+    else:
+        yield from pd.read_csv(file, chunksize=chunksize, dtype="string")
+
+
+def iter_frame_chunks(df, chunksize):
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start : start + chunksize]
+
+
+def quantize_inputs(inputs):
+    """Rounds the inputs of a car to the precision the price depends on, the
+    age to months and the mileage to 1000 km, so that close cars share it"""
+    inputs = dict(inputs)
+    if not is_missing(inputs.get("age_years")):
+        inputs["age_years"] = round(float(inputs["age_years"]) * 12) / 12
+    if not is_missing(inputs.get("Chilometraggio")):
+        inputs["Chilometraggio"] = round(float(inputs["Chilometraggio"]), -3)
+    return inputs
+
+
+class PredictionCache:
+    """Least recently used cache of the predicted prices, keyed by the car
+    inputs. Entries expire after ttl seconds, the oldest ones are evicted
+    beyond maxsize. Shared by threads"""
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, inputs, predict):
+        "Returns the cached price of a car, calling predict(inputs) on a miss"
+        key = tuple(sorted(inputs.items()))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        prediction = predict(inputs)
+        with self.lock:
+            self.entries[key] = (prediction, now)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return prediction
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "size": len(self.entries),
+            }
+
+
+class CompiledModel:
+    """Single car inference without the sklearn pipeline: the fitted
+    imputers, scaler and encoders are read once from the pipeline and the
+    feature row is built in NumPy, then fed to the booster"""
+
+    def __init__(self, model):
+        from sklearn.compose import ColumnTransformer, TransformedTargetRegressor
+        from sklearn.pipeline import Pipeline
+
+        # Models of another structure raise ValueError, to fall back on predict
+        if not isinstance(model, Pipeline):
+            raise ValueError("Expected a Pipeline")
+        target_regressor = model.steps[-1][1]
+        if not isinstance(target_regressor, TransformedTargetRegressor):
+            raise ValueError("Expected a TransformedTargetRegressor as last step")
+        if target_regressor.transformer is not None:
+            raise ValueError("Expected a target transformed by inverse_func")
+        self.inverse_func = target_regressor.inverse_func or (lambda y: y)
+        regressor_pipeline = target_regressor.regressor_
+        if not isinstance(regressor_pipeline, Pipeline) or len(regressor_pipeline) != 2:
+            raise ValueError("Expected a regressor Pipeline of two steps")
+        preprocessor, regressor = [step for _, step in regressor_pipeline.steps]
+        if not isinstance(preprocessor, ColumnTransformer):
+            raise ValueError("Expected a ColumnTransformer as first regressor step")
+        if not hasattr(regressor, "get_booster"):
+            raise ValueError("Expected an XGBoost regressor as last step")
+
+        self.booster = regressor.get_booster()
+        try:
+            self.iteration_range = (0, regressor.best_iteration + 1)
+        except AttributeError:
+            self.iteration_range = (0, 0)
+        # XGBoost reads the entries left out of a sparse matrix as missing
+        self.zeros_missing = preprocessor.sparse_output_
+
+        self.encoders = []
+        num_features = 0
+        for _, transformer, columns in preprocessor.transformers_:
+            if transformer == "drop":
+                continue
+            encoder = self.compile_transformer(transformer, columns, num_features)
+            num_features += encoder["size"]
+            self.encoders.append(encoder)
+        self.num_features = num_features
+        # Hashed values of maker and model, computed once for each value
+        self.hashed = {}
+
+    @staticmethod
+    def compile_transformer(transformer, columns, offset):
+        "Reads the fitted parameters of a column transformer pipeline"
+        from sklearn.pipeline import Pipeline
+
+        steps = dict(transformer.steps) if isinstance(transformer, Pipeline) else {}
+        imputer = steps.get("simpleimputer")
+        if imputer is None or len(steps) != 2:
+            raise ValueError(f"Unsupported transformer for {columns}")
+        if imputer.strategy == "constant":
+            fill_values = [imputer.fill_value] * len(columns)
+        else:
+            fill_values = list(imputer.statistics_)
+
+        if "standardscaler" in steps:
+            scaler = steps["standardscaler"]
+            return {
+                "kind": "numerical",
+                "columns": columns,
+                "offset": offset,
+                "size": len(columns),
+                "fill_values": np.array(fill_values, dtype=np.float64),
+                "mean": scaler.mean_ if scaler.with_mean else 0.0,
+                "scale": scaler.scale_ if scaler.with_std else 1.0,
+            }
+        if "onehotencoder" in steps:
+            encoder = steps["onehotencoder"]
+            # Infrequent categories are private to the encoder, missing before 1.1
+            infrequent = getattr(encoder, "_infrequent_enabled", False)
+            if encoder.drop_idx_ is not None or infrequent:
+                raise ValueError(f"Unsupported one hot encoding for {columns}")
+            positions = {}
+            size = 0
+            for col, categories in zip(columns, encoder.categories_):
+                positions[col] = {
+                    value: size + ii for ii, value in enumerate(categories)
+                }
+                size += len(categories)
+            return {
+                "kind": "one_hot",
+                "columns": columns,
+                "offset": offset,
+                "size": size,
+                "fill_values": fill_values,
+                "positions": positions,
+            }
+        if "featurehasher" in steps and len(columns) == 1:
+            hasher = steps["featurehasher"]
+            return {
+                "kind": "hashed",
+                "columns": columns,
+                "offset": offset,
+                "size": hasher.n_features,
+                "fill_values": fill_values,
+                "hasher": hasher,
+            }
+        raise ValueError(f"Unsupported transformer for {columns}")
+
+    def encode(self, inputs):
+        "Returns the feature row of a car, given as {feature: value}"
+        row = np.zeros(self.num_features, dtype=np.float64)
+        for encoder in self.encoders:
+            offset = encoder["offset"]
+            if encoder["kind"] == "numerical":
+                values = np.array(
+                    [to_float(inputs.get(col)) for col in encoder["columns"]]
+                )
+                values = np.where(np.isnan(values), encoder["fill_values"], values)
+                values -= encoder["mean"]
+                values /= encoder["scale"]
+                row[offset : offset + encoder["size"]] = values
+            elif encoder["kind"] == "one_hot":
+                for col, fill_value in zip(encoder["columns"], encoder["fill_values"]):
+                    value = inputs.get(col)
+                    if is_missing(value):
+                        value = fill_value
+                    # Unknown categories are ignored, as by the encoder
+                    position = encoder["positions"][col].get(value)
+                    if position is not None:
+                        row[offset + position] = 1.0
+            else:
+                col = encoder["columns"][0]
+                value = inputs.get(col)
+                if is_missing(value):
+                    value = encoder["fill_values"][0]
+                indices, values = self.get_hashed(encoder["hasher"], col, value)
+                row[offset + indices] = values
+        if self.zeros_missing:
+            row[row == 0] = np.nan
+        return row
+
+    def get_hashed(self, hasher, col, value):
+        key = (col, value)
+        if key not in self.hashed:
+            hashed = hasher.transform([[value]])
+            self.hashed[key] = (hashed.indices, hashed.data)
+        return self.hashed[key]
+
+    def predict_one(self, inputs):
+        "Returns the predicted price of a car, given as {feature: value}"
+        row = self.encode(inputs)
+        prediction = self.booster.inplace_predict(
+            row[np.newaxis, :], iteration_range=self.iteration_range, missing=np.nan
+        )
+        return float(self.inverse_func(prediction)[0])
+
+
+def is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
@@ -61,6 +61,26 @@ price_by_year_line = (
 price_by_year_chart = price_by_year_area + price_by_year_line
 st.altair_chart(price_by_year_chart, theme="streamlit")
 
+# Price drift section
+st.subheader("Price Drift")
+st.caption("Weekly median change of the prices edited by the sellers")
+price_drift_df = serving_helpers.get_price_drift(26)
+if len(price_drift_df) > 0:
+    price_drift_chart = (
+        alt.Chart(price_drift_df)
+        .mark_line(point=True)
+        .encode(
+            x=alt.X("week:T", title="Week"),
+            y=alt.Y("median_change", title="Price Change (%)"),
+            tooltip=[
+                alt.Tooltip("median_change", title="Median Change (%)", format=".1f"),
+                alt.Tooltip("num_changes", title="Price Changes"),
+            ],
+        )
+    )
+    st.altair_chart(price_drift_chart, theme="streamlit")
+else:
+    st.write("No price changes tracked yet")
 
 # Raw data section
 raw_data = serving_helpers.load_data(2000)
@@ -7,6 +7,7 @@ body_types_list = ['Berlina','SUV/Fuoristrada','Station Wagon','City Car', 'Mono
 fuel_types_list = ["Benzina", "Diesel", "Metano", "GPL", "Ibrida", "Elettrica"]
 gear_list = ["Manuale", "Automatico", "Semiautomatico"]
 drive_wheel_list = ['Anteriore', 'Posteriore', 'Integrale']
+feature_labels = {"age_years": "Age", "Chilometraggio": "Mileage", "potenza_cv": "Power"}
 
 
 def main():
@@ -113,11 +114,25 @@ def main():
         age_years=age_years,
     )
 
+    out_of_range = serving_helpers.get_features_out_of_range(inputs)
+    if out_of_range:
+        st.caption(
+            f"{', '.join(feature_labels[col] for col in out_of_range)} outside the usual range of the offers "
+            f"of the {maker} {model}, the estimate may be less accurate"
+        )
+
     if st.button("Submit"):
         price = round(serving_helpers.make_prediction(inputs))
         st.balloons()
         st.metric(label="Estimated value", value=str(price)+'€')
 
+    cache_stats = serving_helpers.get_prediction_cache_stats()
+    st.sidebar.caption(
+        f"Prediction cache: {cache_stats['hits']} hits, "
+        f"{cache_stats['misses']} misses "
+        f"({cache_stats['hit_rate']:.0%} hit rate), {cache_stats['size']} entries"
+    )
+
 
 
 if __name__ == "__main__":
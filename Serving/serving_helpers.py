@@ -1,71 +1,130 @@
 import os
+import sqlite3
+import threading
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 import streamlit as st
-import joblib
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+import dashboard_aggregates
+import inference
+import json
 from datetime import datetime
 
+path_to_price_history = os.path.join("..", "data", "usedcars_price_history.sqlite")
+# Aggregates and offers exported by dashboard_aggregates, the aggregates are
+# computed from load_data if missing
+path_to_dashboard_aggregates = dashboard_aggregates.path_to_dashboard_aggregates
+path_to_offers = dashboard_aggregates.path_to_offers
+data_columns = dashboard_aggregates.data_columns
+
+
+@st.cache_resource(max_entries=1)
+def get_offers_table(mtime):
+    """Memory maps the offers exported by dashboard_aggregates. The table is shared by
+    all the sessions, its buffers by all the processes mapping the file.
+    A new file, with a new mtime, is mapped again and replaces the previous
+    mapping, releasing the replaced file"""
+    return pa.ipc.open_file(pa.memory_map(path_to_offers)).read_all()
+
+
+def load_data(nrows: int, columns=data_columns, lowercase=True):
+    """Reads the given columns of the valid offers, up to nrows. Only the
+    selected rows and columns of the shared table are copied to pandas"""
+    if not os.path.isfile(path_to_offers):
+        return scan_data(nrows, columns, lowercase)
+    offers = get_offers_table(os.path.getmtime(path_to_offers))
+    table = offers.select(list(columns))
+    if nrows:
+        table = table.slice(0, nrows)
+    return to_dataframe(table, lowercase)
+
+
+def scan_data(nrows: int, columns=data_columns, lowercase=True):
+    """Reads the given columns of the valid offers from the dataset, up to
+    nrows. The offers filter and the row limit are applied while scanning the
+    dataset, so that row groups without valid offers are skipped and the scan
+    stops at nrows"""
+    dataset = ds.dataset(dashboard_aggregates.path_to_dataset, format="parquet")
+    condition = dashboard_aggregates.get_offers_filter()
+    if nrows:
+        table = dataset.head(nrows, columns=list(columns), filter=condition)
+    else:
+        table = dataset.to_table(columns=list(columns), filter=condition)
+    return to_dataframe(table, lowercase)
+
+
+def to_dataframe(table, lowercase=True):
+    data = table.to_pandas().reset_index(drop=True)
+    if lowercase:
+        data.rename(lambda x: str(x).lower(), axis="columns", inplace=True)
+    for col in data.columns:
+        if col.lower() in ["anno", "date"]:
+            data[col] = pd.to_datetime(data[col])
+    return data
 
-@st.cache_data
-def filter_usedcars_data(
-    df, max_price=1e6, min_price=100, max_cv=1000, max_km=1e6, max_engsize=1e4
-):
-    df = df.query(
-        "~((potenza_cv > @max_cv or potenza_cv < 0) \
-                                or (Chilometraggio>@max_km or Chilometraggio < 0) \
-                                or (price > @max_price or price < @min_price ) \
-                                or (Cilindrata_cm3 > @max_engsize or Cilindrata_cm3 < 0 ) \
-                    )"
-    )
-    return df
 
+# The model is loaded on the first prediction, or ahead by the warm-up
+@st.cache_resource(show_spinner=False)
+def load_model():
+    return inference.load_model()
 
-@st.cache_data
-def load_data(nrows: int):
-    columns = [
-        "date",
-        "maker",
-        "model",
-        "Anno",
-        "Chilometraggio",
-        "potenza_cv",
-        "Carburante",
-        "Carrozzeria",
-        "Cilindrata_cm3",
-        "Tipo_di_cambio",
-        "Trazione",
-        "price",
-    ]
-    data = pd.read_parquet(
-        os.path.join("..", "data", "usedcars_dataset.parquet"),
-        columns=columns,
-    )
-    data = data.dropna()
-    data = filter_usedcars_data(data)
-    data = data.reset_index(drop=True)
-    data = data.head(nrows)
-    lowercase = lambda x: str(x).lower()
-    data.rename(lowercase, axis="columns", inplace=True)
-    data["anno"] = pd.to_datetime(data["anno"])
-    data["date"] = pd.to_datetime(data["date"])
-    return data
+
+@st.cache_resource(show_spinner=False)
+def load_compiled_model():
+    "Returns the compiled inference path of the model, None if not supported"
+    try:
+        return inference.CompiledModel(load_model())
+    except (ValueError, AttributeError, TypeError):
+        return None
 
 
 @st.cache_resource
-def load_model():
-    model_path = os.path.join("..", "Modeling", "models", "XGB_final.joblib")
-    with open(model_path, "rb") as model_file:
-        model = joblib.load(model_file)
-    return model
+def get_prediction_cache():
+    "Returns the cache of the predictions, shared by all the sessions"
+    return inference.PredictionCache(maxsize=10000, ttl=24 * 3600)
 
 
-model = load_model()
+def predict_car(car: dict):
+    compiled_model = load_compiled_model()
+    if compiled_model is not None:
+        return compiled_model.predict_one(car)
+    inputs = {key: [value] for key, value in car.items()}
+    return inference.predict(load_model(), pd.DataFrame.from_dict(inputs))[0]
 
 
-@st.cache_data
 def make_prediction(inputs: dict):
-    prediction = model.predict(pd.DataFrame.from_dict(inputs))[0]
-    return prediction
+    "Returns the predicted price of the packed inputs, cached once quantized"
+    car = {key: values[0] for key, values in inputs.items()}
+    return get_prediction_cache().get(inference.quantize_inputs(car), predict_car)
+
+
+def get_prediction_cache_stats():
+    return get_prediction_cache().stats()
+
+
+warm_up_lock = threading.Lock()
+warm_up_started = False
+
+
+def start_warm_up():
+    """Loads the model and the catalog in a background thread, once for each
+    process, so that pages render without waiting for them"""
+    global warm_up_started
+    with warm_up_lock:
+        if warm_up_started:
+            return
+        warm_up_started = True
+    thread = threading.Thread(target=warm_up, name="warm_up", daemon=True)
+    # The cached functions run in the script context of the calling session
+    add_script_run_ctx(thread)
+    thread.start()
+
+
+def warm_up():
+    load_compiled_model()
+    get_catalog()
 
 
 @st.cache_data
@@ -74,36 +133,83 @@ def pack_inputs(**inputs_unpacked):
     return inputs_packed
 
 
-@st.cache_data
-def get_makers(num_makers=40):
-    data = load_data(None)
-    makers = data.value_counts(["maker"]).sort_values(ascending=False)
-    num_makers = min(len(makers), num_makers)
-    makers = makers.reset_index().loc[:num_makers, "maker"].to_numpy()
-    return np.sort(makers)
+@st.cache_resource(show_spinner=False)
+def get_catalog():
+    """Returns the index of the dropdowns of the Car Evaluator: the sorted top
+    makers, their sorted top models and the feature ranges of each model.
+    Read from the exported catalog, listed from the offers by model
+    without ranges if missing"""
+    catalog = read_aggregate("catalog.json")
+    if catalog is None:
+        catalog = list_catalog()
+    return {
+        "makers": np.sort(list(catalog)),
+        "models": {
+            maker: np.sort(list(entry["models"])) for maker, entry in catalog.items()
+        },
+        "ranges": {
+            (maker, model): model_entry["ranges"]
+            for maker, entry in catalog.items()
+            for model, model_entry in entry["models"].items()
+        },
+    }
 
 
-@st.cache_data
-def get_models(maker, num_models=30):
-    data = load_data(None).query("maker==@maker")
-    models = data.value_counts(["model"]).sort_values(ascending=False)
-    num_models = min(len(models), num_models)
-    models = models.reset_index().loc[:num_models, "model"].to_numpy()
-    return np.sort(models)
+def list_catalog(num_makers=40, num_models=30):
+    "Lists the top makers with their top models, by number of offers"
+    by_model = get_aggregates_by_model().astype({"maker": str, "model": str})
+    by_model = by_model.sort_values("model_count", ascending=False, kind="stable")
+    makers = (
+        by_model.groupby("maker")["model_count"]
+        .sum()
+        .sort_values(ascending=False, kind="stable")
+        .head(num_makers)
+    )
+    catalog = {}
+    for maker in makers.index:
+        models = by_model.loc[by_model["maker"] == maker, "model"].head(num_models)
+        catalog[maker] = {"models": {model: {"ranges": {}} for model in models}}
+    return catalog
+
+
+def get_makers():
+    return get_catalog()["makers"]
+
+
+def get_models(maker):
+    return get_catalog()["models"].get(maker, np.array([]))
+
+
+def get_features_out_of_range(inputs: dict):
+    """Returns the features of the packed inputs outside the range of the
+    offers of their model, empty if the model is not in the catalog"""
+    car = {key: values[0] for key, values in inputs.items()}
+    ranges = get_catalog()["ranges"].get((car["maker"], car["model"]), {})
+    return [
+        col
+        for col, (low, high) in ranges.items()
+        if not inference.is_missing(car.get(col)) and not low <= car[col] <= high
+    ]
+
+
+def read_aggregate(name):
+    "Returns an exported aggregate, None if missing"
+    path = os.path.join(path_to_dashboard_aggregates, name)
+    if not os.path.isfile(path):
+        return None
+    if name.endswith(".json"):
+        with open(path) as file:
+            return json.load(file)
+    return pd.read_parquet(path)
 
 
 @st.cache_data
 def get_aggregates_by_model():
-    data = load_data(None)
-    aggregated_data = (
-        data.groupby(["maker", "model"])
-        .agg(
-            model_count=pd.NamedAgg(column="model", aggfunc="count"),
-            price_sum=pd.NamedAgg(column="price", aggfunc="sum"),
-        )
-        .reset_index()
-    )
-    return aggregated_data
+    aggregated_data = read_aggregate("by_model.parquet")
+    if aggregated_data is not None:
+        return aggregated_data
+    data = load_data(None, columns=("maker", "model", "price"), lowercase=False)
+    return dashboard_aggregates.get_aggregates_by_model(data)
 
 
 @st.cache_data
@@ -111,7 +217,7 @@ def get_top_selling_models(num_models=10):
     df = get_aggregates_by_model()
     df = df.sort_values(by="model_count", ascending=False)
     df = df.head(num_models)
-    df["maker_model"] = df["maker"] + " " + df["model"]
+    df["maker_model"] = df["maker"].astype(str) + " " + df["model"].astype(str)
     df = df[["maker_model", "model_count"]]
     df = df.rename(columns={"maker_model": "Model", "model_count": "Number of Offers"})
     df.index = np.arange(1, len(df) + 1)
@@ -121,7 +227,7 @@ def get_top_selling_models(num_models=10):
 @st.cache_data
 def get_top_value_makers(num_makers=10):
     df = get_aggregates_by_model()
-    df = df.groupby(by="maker").agg({"price_sum": "sum"})
+    df = df.groupby(by="maker", observed=True).agg({"price_sum": "sum"})
     df = df.sort_values(by="price_sum", ascending=False).reset_index().head(num_makers)
     df["price_sum"] = df["price_sum"] * 1e-6
     df = df.rename(columns={"maker": "Maker", "price_sum": "Sum of Prices (Million €)"})
@@ -131,7 +237,7 @@ def get_top_value_makers(num_makers=10):
 
 @st.cache_data
 def get_car_counts_by_year(num_years=30):
-    data = load_data(None)
+    data = load_data(None, columns=("Anno",))
     df = data["anno"].dt.year.value_counts()
     df = df.rename_axis("Year").reset_index(name="Counts")
     if num_years:
@@ -141,14 +247,10 @@ def get_car_counts_by_year(num_years=30):
 
 @st.cache_data
 def get_car_counts_by_year_and_bodytype(num_years=30):
-    data = load_data(None)
-    df = (
-        data.groupby([data["anno"].dt.year, "carrozzeria"])
-        .count()
-        .rename(columns={"anno": "Counts"})["Counts"]
-        .reset_index()
-    )
-    df = df.rename(columns={"anno": "Year", "carrozzeria": "Body Type"})
+    df = read_aggregate("by_year_bodytype.parquet")
+    if df is None:
+        data = load_data(None, columns=("Anno", "Carrozzeria"), lowercase=False)
+        df = dashboard_aggregates.get_car_counts_by_year_and_bodytype(data)
     if num_years:
         year_limit = datetime.now().year - num_years
         df = df.query("Year>@year_limit")
@@ -157,17 +259,10 @@ def get_car_counts_by_year_and_bodytype(num_years=30):
 
 @st.cache_data
 def get_car_prices_by_year(num_years=30):
-    data = load_data(None)
-    df = (
-        data.groupby(data["anno"].dt.year)
-        .agg(
-            q_min=pd.NamedAgg(column="price", aggfunc=lambda x: x.quantile(0.25)),
-            q_max=pd.NamedAgg(column="price", aggfunc=lambda x: x.quantile(0.75)),
-            median=pd.NamedAgg(column="price", aggfunc="median"),
-        )
-        .reset_index()
-    )
-    df["anno"] = df["anno"].astype("int64")
+    df = read_aggregate("prices_by_year.parquet")
+    if df is None:
+        data = load_data(None, columns=("Anno", "price"), lowercase=False)
+        df = dashboard_aggregates.get_car_prices_by_year(data)
     if num_years:
         df = df.tail(num_years)
     return df
@@ -175,14 +270,45 @@ def get_car_prices_by_year(num_years=30):
 
 @st.cache_data
 def get_gauges():
-    data = load_data(None)
-    num_offers = f"{len(data):d}"
-    median_price = f"{data['price'].median():.0f} €"
-    median_age = ((data["date"] - data["anno"]).median()) / np.timedelta64(1, "Y")
-    median_age = f"{median_age:.1f} Y"
+    gauges = read_aggregate("gauges.json")
+    if gauges is None:
+        data = load_data(None, columns=("date", "Anno", "price"), lowercase=False)
+        gauges = dashboard_aggregates.get_gauges(data)
+    num_offers = f"{gauges['num_offers']:d}"
+    median_price = f"{gauges['median_price']:.0f} €"
+    median_age = f"{gauges['median_age']:.1f} Y"
     return num_offers, median_price, str(median_age)
 
 
+@st.cache_data
+def get_price_drift(num_weeks=26):
+    "Weekly median change (%) of the prices changed by the sellers"
+    if not os.path.isfile(path_to_price_history):
+        return pd.DataFrame(columns=["week", "median_change", "num_changes"])
+    connection = sqlite3.connect(path_to_price_history)
+    df = pd.read_sql_query(
+        "SELECT date, price, "
+        "LAG(price) OVER (PARTITION BY listing_id ORDER BY date) AS previous_price "
+        "FROM prices",
+        connection,
+    )
+    connection.close()
+    df = df.dropna()
+    df["change"] = (df["price"] / df["previous_price"] - 1) * 100
+    df["week"] = pd.to_datetime(df["date"], unit="s").dt.to_period("W").dt.start_time
+    df = (
+        df.groupby("week")
+        .agg(
+            median_change=pd.NamedAgg(column="change", aggfunc="median"),
+            num_changes=pd.NamedAgg(column="change", aggfunc="count"),
+        )
+        .reset_index()
+    )
+    if num_weeks:
+        df = df.tail(num_weeks)
+    return df
+
+
 @st.cache_data
 def edit_columns_display(df):
     columns_translation = {